@@ -0,0 +1,72 @@
+#! /usr/bin/env python3
+
+# Compare the serial checkout path with the parallel one on a synthetic
+# tree.  Usage: bench_checkout.py [--files N] [--size BYTES] [--jobs N]
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyglib
+
+def build_tree(repo, rng, files, size, width):
+    # Write files blobs spread over directories of at most width
+    # entries, and return the SHA of the root tree.
+    leaves = []
+    for i in range(files):
+        blob = pyglib.Blob(repo, bytes(rng.getrandbits(8) for _ in range(64)) * (size // 64))
+        leaves.append(pyglib.Leaf(b'100644', "f{0:06}".format(i).encode(), pyglib.write_object(blob)))
+    level = 0
+    while len(leaves) > width:
+        groups = [leaves[i:i+width] for i in range(0, len(leaves), width)]
+        leaves = []
+        for i, group in enumerate(groups):
+            tree = pyglib.Tree(repo)
+            tree.items = group
+            leaves.append(pyglib.Leaf(b'40000', "d{0}_{1:04}".format(level, i).encode(), pyglib.write_object(tree)))
+        level += 1
+    tree = pyglib.Tree(repo)
+    tree.items = leaves
+    return pyglib.write_object(tree)
+
+def run(repo, tree, jobs, processes=False):
+    dest = tempfile.mkdtemp(prefix="pyg-bench-checkout-")
+    try:
+        start = time.perf_counter()
+        pyglib.checkout_tree(repo, tree, os.path.realpath(dest).encode(), jobs, processes)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(dest)
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark pyg checkout")
+    argparser.add_argument("--files", type=int, default=5000)
+    argparser.add_argument("--size", type=int, default=16384)
+    argparser.add_argument("--width", type=int, default=100)
+    argparser.add_argument("--jobs", type=int, default=os.cpu_count())
+    argparser.add_argument("--repeat", type=int, default=3)
+    args = argparser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="pyg-bench-repo-")
+    try:
+        repo = pyglib.create_repo(os.path.join(path, "repo"))
+        repo = pyglib.Repository(repo.worktree)
+        sha = build_tree(repo, random.Random(0), args.files, args.size, args.width)
+        tree = pyglib.read_object(repo, sha)
+        print("{0} files of {1} bytes".format(args.files, args.size))
+        for label, jobs, processes in [("serial", 1, False),
+                                       ("threads", args.jobs, False),
+                                       ("processes", args.jobs, True)]:
+            best = min(run(repo, tree, jobs, processes) for _ in range(args.repeat))
+            print("{0:>10} jobs={1:<3} {2:8.3f}s {3:10.0f} files/s".format(
+                label, jobs, best, args.files / best))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
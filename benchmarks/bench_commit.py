@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+# Header access, full parsing and serialization throughput of commits.
+# Usage: bench_commit.py [--commits N] [--repeat N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyglib
+
+def make_commits(rng, count):
+    ret = []
+    for i in range(count):
+        lines = [b'tree ' + rng.randbytes(20).hex().encode()]
+        for _ in range(2 if i % 10 == 0 else 1):
+            lines.append(b'parent ' + rng.randbytes(20).hex().encode())
+        lines.append(b'author A U Thor <author@example.com> %d +0000' % (1000000000 + i))
+        lines.append(b'committer C O Mitter <committer@example.com> %d +0000' % (1000000000 + i))
+        message = b'Commit %d\n\n' % i + b'Some explanation of the change.\n' * rng.randrange(1, 20)
+        ret.append(b'\n'.join(lines) + b'\n\n' + message)
+    return ret
+
+def timed(label, count, repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{0:>28} {1:10.4f}s {2:14.0f} commits/s".format(label, best, count / best))
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark commit parsing and serialization")
+    argparser.add_argument("--commits", type=int, default=100000)
+    argparser.add_argument("--repeat", type=int, default=5)
+    args = argparser.parse_args()
+
+    raws = make_commits(random.Random(0), args.commits)
+    n = args.commits
+    print("{0} commits, {1} bytes".format(n, sum(len(r) for r in raws)))
+    timed("tree + parents", n, args.repeat,
+          lambda: [(c.header(b'tree'), c.headers(b'parent'))
+                   for c in (pyglib.Commit(None, raw) for raw in raws)])
+    timed("parents + committer time", n, args.repeat,
+          lambda: [(pyglib.commit_parents(c), pyglib.commit_time(c))
+                   for c in (pyglib.Commit(None, raw) for raw in raws)])
+    timed("subject", n, args.repeat,
+          lambda: [pyglib.Commit(None, raw).subject() for raw in raws])
+    timed("full parse (map_with_msg)", n, args.repeat,
+          lambda: [pyglib.Commit(None, raw).map_with_msg for raw in raws])
+    timed("serialize (unchanged)", n, args.repeat,
+          lambda: [pyglib.Commit(None, raw).serialize() for raw in raws])
+    def roundtrip():
+        for raw in raws:
+            commit = pyglib.Commit(None, raw)
+            commit.map_with_msg
+            assert commit.serialize() == raw
+    timed("full parse + serialize", n, args.repeat, roundtrip)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+# Startup cost of the pyg command: import time of pyglib, as reported by
+# "python -X importtime", and time to first output of rev-parse and
+# cat-file, each run in a fresh interpreter.  Give --pyg several times
+# to compare checkouts (e.g. a worktree of an older commit).  Bytecode
+# is written (and a first run left untimed), as for any installed pyg.
+# Usage: bench_startup.py [--repo PATH] [--pyg DIR]... [--runs N]
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import pyglib
+import genrepo
+
+ENV = dict(os.environ)
+ENV.pop("PYTHONDONTWRITEBYTECODE", None)
+
+# Microseconds spent importing pyglib (and everything it imports)
+def import_time(pyg):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                          "import sys; sys.path.insert(0, {0!r}); import pyglib".format(pyg)],
+                         check=True, stderr=subprocess.PIPE, env=ENV)
+    for line in out.stderr.decode().splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "pyglib":
+            return int(fields[1])
+    raise Exception("pyglib not found in -X importtime output")
+
+# Seconds from spawning pyg to the first byte it writes on stdout
+def first_output(pyg, repo, argv):
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable, os.path.join(pyg, "pyg")] + argv,
+                         cwd=repo, stdout=subprocess.PIPE, env=ENV)
+    first = p.stdout.read(1)
+    elapsed = time.perf_counter() - start
+    p.stdout.read()
+    if p.wait() != 0 or not first:
+        raise Exception("pyg {0} failed".format(" ".join(argv)))
+    return elapsed
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark pyg startup")
+    argparser.add_argument("--repo", help="Run in this repository instead of a generated one")
+    argparser.add_argument("--pyg", action="append",
+                           help="Directory of the pyg to time (default: this checkout)")
+    argparser.add_argument("--runs", type=int, default=20)
+    args = argparser.parse_args()
+
+    tmp = None
+    repo = args.repo
+    if not repo:
+        tmp = tempfile.mkdtemp(prefix="pyg-bench-startup-")
+        repo = os.path.join(tmp, "repo")
+        genrepo.generate(repo, commits=20, tags=2)
+    try:
+        r = pyglib.Repository(repo)
+        head = pyglib.resolve_ref(r, "HEAD")
+        tree = pyglib.read_object(r, pyglib.read_object(r, head).header(b'tree').decode("ascii"))
+        blob = next(item.sha for item in tree if pyglib.mode_type(item.mode) == b'blob')
+        commands = [["rev-parse", "HEAD"], ["cat-file", "blob", blob]]
+
+        print("{0:>40} {1:>14} {2:>14} {3:>14}".format("", "import", "min", "median"))
+        for pyg in args.pyg or [os.path.join(HERE, "..")]:
+            pyg = os.path.abspath(pyg)
+            import_time(pyg)
+            imports = [import_time(pyg) for _ in range(args.runs)]
+            print("{0:>40} {1:>12.1f}ms".format(pyg[-40:], min(imports) / 1000))
+            for argv in commands:
+                times = [first_output(pyg, repo, argv) for _ in range(args.runs)]
+                print("{0:>40} {1:>14} {2:>12.1f}ms {3:>12.1f}ms".format(
+                    " ".join(argv)[:40], "", min(times) * 1000, statistics.median(times) * 1000))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
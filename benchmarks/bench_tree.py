@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# Parse and serialize throughput of tree objects.
+# Usage: bench_tree.py [--entries N] [--repeat N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyglib
+
+def make_tree(rng, entries):
+    leaves = []
+    for i in range(entries):
+        mode = b'40000' if i % 10 == 0 else b'100644'
+        name = "entry-{0:08}".format(i).encode()
+        leaves.append(pyglib.Leaf(mode, name, binsha=rng.randbytes(20)))
+    leaves.sort(key=lambda l: l.path + b'/' if l.mode == b'40000' else l.path)
+    tree = pyglib.Tree(None)
+    tree.items = leaves
+    return tree.serialize(), [l.path for l in leaves]
+
+def timed(label, entries, repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{0:>24} {1:10.4f}s {2:14.0f} entries/s".format(label, best, entries / best))
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark tree parsing and serialization")
+    argparser.add_argument("--entries", type=int, default=10000)
+    argparser.add_argument("--repeat", type=int, default=5)
+    args = argparser.parse_args()
+
+    raw, names = make_tree(random.Random(0), args.entries)
+    n = args.entries
+    print("{0} entries, {1} bytes".format(n, len(raw)))
+    timed("parse", n, args.repeat, lambda: pyglib.Tree(None, raw))
+    timed("parse + iterate", n, args.repeat,
+          lambda: [leaf.path for leaf in pyglib.Tree(None, raw)])
+    timed("parse + iterate + hex", n, args.repeat,
+          lambda: [leaf.sha for leaf in pyglib.Tree(None, raw)])
+    timed("serialize (unchanged)", n, args.repeat,
+          lambda: pyglib.Tree(None, raw).serialize())
+    def rebuild():
+        tree = pyglib.Tree(None, raw)
+        tree.items = list(tree)
+        assert tree.serialize() == raw
+    timed("parse + rebuild", n, args.repeat, rebuild)
+    tree = pyglib.Tree(None, raw)
+    timed("find (all names)", n, args.repeat,
+          lambda: [tree.find(name) for name in names])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+
+# Build a synthetic repository of a given shape, deterministically: the
+# same parameters always give the same objects and refs.  Everything is
+# written through pyglib (write_object, create_ref), then packed unless
+# --loose is given.
+# Usage: genrepo.py PATH [--files N] [--dirs N] [--depth N] [--size BYTES]
+#                        [--commits N] [--changes N] [--tags N] [--seed N]
+#                        [--loose | --window N]
+
+import argparse
+import collections
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyglib
+
+# Defaults, also used by the benchmark suite
+SHAPE = {
+    "files": 16,        # files per directory
+    "dirs": 4,          # subdirectories per directory
+    "depth": 3,         # levels of directories, the root included
+    "size": 4096,       # average blob size
+    "commits": 200,
+    "changes": 5,       # files modified by each commit
+    "tags": 20,         # annotated tags, spread over history
+    "seed": 0,
+}
+
+class Dir(object):
+    # A directory of the worktree being generated: entries map names to
+    # blob SHAs or Dirs, sha is that of the last tree written for it, or
+    # None once something below changed.
+    __slots__ = ("entries", "sha")
+
+    def __init__(self):
+        self.entries = dict()
+        self.sha = None
+
+def blob_data(rng, size):
+    # Somewhat compressible, like source code, and never the same twice.
+    size = max(1, int(size * rng.uniform(0.5, 1.5)))
+    return (rng.randbytes(48) * (size // 48 + 1))[:size]
+
+def write_tree(repo, d):
+    if d.sha is None:
+        leaves = []
+        for name, value in d.entries.items():
+            if isinstance(value, Dir):
+                leaves.append(pyglib.Leaf(b'40000', name, write_tree(repo, value)))
+            else:
+                leaves.append(pyglib.Leaf(b'100644', name, value))
+        leaves.sort(key=lambda l: l.path + b'/' if l.mode == b'40000' else l.path)
+        tree = pyglib.Tree(repo)
+        tree.items = leaves
+        d.sha = pyglib.write_object(tree)
+    return d.sha
+
+def write_commit(repo, tree, parents, when, message):
+    commit = pyglib.Commit(repo)
+    fields = collections.OrderedDict()
+    fields[b'tree'] = tree.encode()
+    if parents:
+        fields[b'parent'] = [p.encode() for p in parents] if len(parents) > 1 else parents[0].encode()
+    fields[b'author'] = b'A U Thor <author@example.com> %d +0000' % when
+    fields[b'committer'] = b'C O Mitter <committer@example.com> %d +0000' % when
+    fields[b''] = message
+    commit.map_with_msg = fields
+    return pyglib.write_object(commit)
+
+def write_tag(repo, name, sha, when):
+    tag = pyglib.Tag(repo)
+    fields = collections.OrderedDict()
+    fields[b'object'] = sha.encode()
+    fields[b'type'] = b'commit'
+    fields[b'tag'] = name.encode()
+    fields[b'tagger'] = b'C O Mitter <committer@example.com> %d +0000' % when
+    fields[b''] = b'Release ' + name.encode() + b'\n'
+    tag.map_with_msg = fields
+    return pyglib.write_object(tag)
+
+# Create the repository at path and return a summary of what was written.
+def generate(path, files=SHAPE["files"], dirs=SHAPE["dirs"], depth=SHAPE["depth"],
+             size=SHAPE["size"], commits=SHAPE["commits"], changes=SHAPE["changes"],
+             tags=SHAPE["tags"], seed=SHAPE["seed"], pack=True, window=10):
+    rng = random.Random(seed)
+    repo = pyglib.create_repo(path)
+    repo = pyglib.Repository(repo.worktree)
+
+    root = Dir()
+    paths = []
+    with pyglib.ObjectBatch(repo):
+        stack = [(root, [], 1)]
+        while stack:
+            d, parents, level = stack.pop()
+            for i in range(files):
+                name = "file{0:03}.txt".format(i).encode()
+                d.entries[name] = pyglib.write_object(pyglib.Blob(repo, blob_data(rng, size)))
+                paths.append(parents + [d, name])
+            if level < depth:
+                for i in range(dirs):
+                    sub = Dir()
+                    d.entries["dir{0:02}".format(i).encode()] = sub
+                    stack.append((sub, parents + [d], level + 1))
+
+        head = None
+        history = []
+        when = 1500000000
+        for n in range(commits):
+            if head is not None:
+                for chosen in rng.sample(paths, min(changes, len(paths))):
+                    *ancestors, d, name = chosen
+                    d.entries[name] = pyglib.write_object(pyglib.Blob(repo, blob_data(rng, size)))
+                    for a in ancestors + [d]:
+                        a.sha = None
+            when += rng.randrange(60, 7200)
+            head = write_commit(repo, write_tree(repo, root), [head] if head else [],
+                                when, b'Commit %d\n\nGenerated.\n' % n)
+            history.append((head, when))
+        pyglib.create_ref(repo, "heads/master", head)
+        for i in range(tags):
+            sha, when = history[(i + 1) * len(history) // tags - 1]
+            pyglib.create_ref(repo, "tags/v{0}".format(i), write_tag(repo, "v{0}".format(i), sha, when))
+
+    if pack:
+        pyglib.repack(repo, True, window)
+    return {
+        "path": path,
+        "files": len(paths),
+        "commits": commits,
+        "tags": tags,
+        "head": head,
+        "packed": pack,
+    }
+
+def main():
+    argparser = argparse.ArgumentParser(description="Generate a synthetic repository")
+    argparser.add_argument("path")
+    for key, value in SHAPE.items():
+        argparser.add_argument("--" + key, type=int, default=value)
+    argparser.add_argument("--loose", action="store_true", help="Don't pack the objects")
+    argparser.add_argument("--window", type=int, default=10, help="Delta window of the pack (0: no deltas)")
+    args = argparser.parse_args()
+    shape = {key: getattr(args, key) for key in SHAPE}
+    info = generate(args.path, pack=not args.loose, window=args.window, **shape)
+    print("{0}: {1} files, {2} commits, {3} tags, HEAD {4}".format(
+        info["path"], info["files"], info["commits"], info["tags"], info["head"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#! /usr/bin/env python3
+
+# Time pyg on a synthetic repository (see genrepo.py) or an existing one.
+# Each scenario runs in its own process, so that its peak RSS is its own,
+# on a freshly opened repository for every run.  Results are printed and
+# written as JSON, to compare versions with --compare.
+# Usage: suite.py [--repo PATH | --cache DIR] [genrepo.py shape options]
+#                 [--scenario NAME]... [--repeat N] [--output FILE]
+#                 [--compare FILE]
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import pyglib
+import genrepo
+
+# Everything a scenario needs, gathered before it is timed: the
+# objects reachable from HEAD's tree, and the commits and refs.
+class Context(object):
+    def __init__(self, path):
+        self.path = path
+        repo = pyglib.Repository(path)
+        self.head = pyglib.resolve_ref(repo, "HEAD")
+        self.tree = pyglib.read_object(repo, self.head).header(b'tree').decode("ascii")
+        self.trees = []
+        self.blobs = []
+        stack = [self.tree]
+        while stack:
+            sha = stack.pop()
+            self.trees.append(sha)
+            for item in pyglib.read_object(repo, sha):
+                fmt = pyglib.mode_type(item.mode)
+                if fmt == b'tree':
+                    stack.append(item.sha)
+                elif fmt == b'blob':
+                    self.blobs.append(item.sha)
+        self.commits = list(pyglib.rev_walk(repo, [self.head]))
+        self.refs = pyglib.repo_refs(repo).all()
+
+    def repo(self):
+        return pyglib.Repository(self.path)
+
+# Scenarios: each is called once per run with the context and returns a
+# function to time, and the number of operations it performs.
+
+def scenario_hash_object(ctx):
+    # hash-object -w of the blobs of HEAD, from files, into an empty
+    # repository
+    repo = ctx.repo()
+    tmp = tempfile.mkdtemp(prefix="pyg-bench-hash-")
+    files = []
+    for i, sha in enumerate(ctx.blobs):
+        name = os.path.join(tmp, "f{0}".format(i))
+        with open(name, "wb") as f:
+            f.write(pyglib.read_object(repo, sha).serialize())
+        files.append(name)
+    target = pyglib.create_repo(os.path.join(tmp, "repo"))
+    target = pyglib.Repository(target.worktree)
+    def run():
+        try:
+            for name in files:
+                with open(name, "rb") as f:
+                    pyglib.hash_object(f, b'blob', target)
+        finally:
+            shutil.rmtree(tmp)
+    return run, len(files)
+
+def scenario_cat_file(ctx):
+    # cat-file --batch of every tree and blob of HEAD
+    names = b''.join(sha.encode() + b'\n' for sha in ctx.trees + ctx.blobs)
+    repo = ctx.repo()
+    def run():
+        pyglib.cat_file_batch(repo, io.BytesIO(names), io.BytesIO(), contents=True, flush=False)
+    return run, len(ctx.trees) + len(ctx.blobs)
+
+def scenario_ls_tree(ctx):
+    # ls-tree of every tree of HEAD
+    repo = ctx.repo()
+    def run():
+        for sha in ctx.trees:
+            for item in pyglib.read_object(repo, sha):
+                "{0} {1} {2}\t{3}".format(item.mode, pyglib.mode_type(item.mode), item.sha, item.path)
+    return run, len(ctx.trees)
+
+def scenario_checkout(ctx):
+    # checkout of HEAD's tree into an empty directory
+    repo = ctx.repo()
+    tmp = tempfile.mkdtemp(prefix="pyg-bench-checkout-")
+    def run():
+        try:
+            pyglib.checkout_tree(repo, pyglib.read_object(repo, ctx.tree), os.fsencode(tmp))
+        finally:
+            shutil.rmtree(tmp)
+    return run, len(ctx.blobs)
+
+def scenario_log(ctx):
+    # log --oneline of the whole history
+    repo = ctx.repo()
+    def run():
+        index = pyglib.repo_object_index(repo)
+        for sha in pyglib.rev_walk(repo, [ctx.head]):
+            index.abbrev(sha)
+            pyglib.read_object(repo, sha).subject()
+    return run, len(ctx.commits)
+
+def scenario_rev_parse(ctx):
+    # rev-parse of the abbreviated name of every commit, and of every ref
+    names = [sha[:7] for sha in ctx.commits] + [name.rsplit("/", 1)[-1] for name, _ in ctx.refs]
+    repo = ctx.repo()
+    def run():
+        for name in names:
+            pyglib.get_object(repo, name)
+    return run, len(names)
+
+def scenario_show_ref(ctx):
+    # show-ref, 100 times, re-reading the refs each time
+    repo = ctx.repo()
+    def run():
+        for _ in range(100):
+            repo.refs = None
+            pyglib.repo_refs(repo).all()
+    return run, 100 * len(ctx.refs)
+
+SCENARIOS = {
+    "hash-object": scenario_hash_object,
+    "cat-file": scenario_cat_file,
+    "ls-tree": scenario_ls_tree,
+    "checkout": scenario_checkout,
+    "log": scenario_log,
+    "rev-parse": scenario_rev_parse,
+    "show-ref": scenario_show_ref,
+}
+
+# Peak resident set size of this process, in KiB
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+# In the child process: time one scenario and print its result as JSON.
+def run_child(name, path, repeat):
+    ctx = Context(path)
+    times = []
+    for _ in range(repeat):
+        run, ops = SCENARIOS[name](ctx)
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(json.dumps({
+        "ops": ops,
+        "seconds": best,
+        "ops_per_sec": ops / best if best else None,
+        "runs": times,
+        "peak_rss_kb": peak_rss(),
+    }))
+
+def run_scenario(name, path, repeat):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                          "--child", name, "--repo", path, "--repeat", str(repeat)],
+                         check=True, stdout=subprocess.PIPE)
+    return json.loads(out.stdout)
+
+def pyg_version():
+    try:
+        out = subprocess.run(["git", "-C", os.path.join(HERE, ".."), "describe", "--always", "--dirty"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return out.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Return the path of the repository to benchmark, generating it if
+# needed, and whether it is temporary.
+def prepare_repo(args, shape):
+    if args.repo:
+        return os.path.abspath(args.repo), False
+    key = "-".join("{0}{1}".format(k, v) for k, v in sorted(shape.items()))
+    if args.cache:
+        path = os.path.join(os.path.abspath(args.cache), "repo-" + key)
+        if os.path.isdir(path):
+            return path, False
+        os.makedirs(args.cache, exist_ok=True)
+        temporary = False
+    else:
+        path = os.path.join(tempfile.mkdtemp(prefix="pyg-bench-"), "repo")
+        temporary = True
+    start = time.perf_counter()
+    genrepo.generate(path, **shape)
+    print("Generated {0} in {1:.1f}s".format(path, time.perf_counter() - start))
+    return path, temporary
+
+def main():
+    argparser = argparse.ArgumentParser(description="Run the pyg benchmark suite")
+    argparser.add_argument("--repo", help="Benchmark this repository instead of a generated one")
+    argparser.add_argument("--cache", help="Keep generated repositories in this directory")
+    for key, value in genrepo.SHAPE.items():
+        argparser.add_argument("--" + key, type=int, default=value)
+    argparser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                           help="Scenario to run (default: all)")
+    argparser.add_argument("--repeat", type=int, default=3)
+    argparser.add_argument("--output", help="JSON file to write (default: bench-DATE.json)")
+    argparser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    argparser.add_argument("--child", help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.repo, args.repeat)
+        return
+
+    shape = {key: getattr(args, key) for key in genrepo.SHAPE}
+    path, temporary = prepare_repo(args, shape)
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)["scenarios"]
+    try:
+        results = dict()
+        print("{0:>12} {1:>8} {2:>10} {3:>12} {4:>10}{5}".format(
+            "scenario", "ops", "seconds", "ops/s", "peak RSS", "  vs old" if old else ""))
+        for name in args.scenario or list(SCENARIOS):
+            r = results[name] = run_scenario(name, path, args.repeat)
+            change = ""
+            if old and name in old and old[name]["ops_per_sec"]:
+                change = " {0:+8.1f}%".format(100 * (r["ops_per_sec"] / old[name]["ops_per_sec"] - 1))
+            print("{0:>12} {1:>8} {2:>10.4f} {3:>12.0f} {4:>7.1f}MiB{5}".format(
+                name, r["ops"], r["seconds"], r["ops_per_sec"], r["peak_rss_kb"] / 1024, change))
+    finally:
+        if temporary:
+            shutil.rmtree(os.path.dirname(path))
+
+    output = args.output or time.strftime("bench-%Y%m%d-%H%M%S.json")
+    with open(output, "w") as f:
+        json.dump({
+            "pyg": pyg_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "repository": args.repo,
+            "shape": None if args.repo else shape,
+            "repeat": args.repeat,
+            "scenarios": results,
+        }, f, indent=2)
+    print("Results written to {0}".format(output))
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,113 @@
 import argparse
+import array
+import bisect
+import codecs
 import collections
 import configparser
-import hashlib
+import heapq
+import mmap
 import os
 import re
+import stat
+import struct
 import sys
+import threading
+import time
 import zlib
 
-argparser = argparse.ArgumentParser(description="content tracker")
+# Commands register the function adding their arguments with @command.
+# Only the subparser of the command given is built, unless there is none
+# (or an unknown one): then they all are, for help and usage errors.
+COMMANDS = dict()
 
-# Handle subcommands (subparsers). i.e., commands like "commit" and "init" after the 
-# initial "git" ("pyg" for this project) command.
-# dest="command" means return the subparser as a string in the "command" field
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+def command(name, **kwargs):
+    def register(arguments):
+        COMMANDS[name] = (kwargs, arguments)
+        return arguments
+    return register
 
-# Subparsers are required. Just "pyg" is insufficient and useless.
-# it has to be "py COMMAND" like "pyg commit" or "pyg add" 
-argsubparsers.required = True
+def make_argparser(argv):
+    argparser = argparse.ArgumentParser(description="content tracker")
+    argparser.add_argument("--perf", action="store_true",
+                           help="Report counters and timings on exit (see PYG_TRACE_PERF)")
+
+    # Handle subcommands (subparsers). i.e., commands like "commit" and "init" after the 
+    # initial "git" ("pyg" for this project) command.
+    # dest="command" means return the subparser as a string in the "command" field
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+
+    # Subparsers are required. Just "pyg" is insufficient and useless.
+    # it has to be "py COMMAND" like "pyg commit" or "pyg add" 
+    argsubparsers.required = True
+
+    name = next((arg for arg in argv if not arg.startswith("-")), None)
+    for name in [name] if name in COMMANDS else COMMANDS:
+        kwargs, arguments = COMMANDS[name]
+        arguments(argsubparsers.add_parser(name, **kwargs))
+    return argparser
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
-
-    # Subparsers
-    # "cmd_*" functions take the parsed args as parameter and proces and
-    # validate them before executing the command 
-    #if   args.command == "add"         : cmd_add(args)
-    if args.command == "cat-file"    : cmd_cat_file(args)
-    elif args.command == "checkout"    : cmd_checkout(args)
-    # elif args.command == "commit"      : cmd_commit(args)
-    elif args.command == "hash-object" : cmd_hash_object(args)
-    elif args.command == "init"        : cmd_init(args)
-    elif args.command == "log"         : cmd_log(args)
-    elif args.command == "ls-tree"     : cmd_ls_tree(args)
-    # elif args.command == "merge"       : cmd_merge(args)
-    # elif args.command == "rebase"      : cmd_rebase(args)
-    elif args.command == "rev-parse"   : cmd_rev_parse(args)
-    # elif args.command == "rm"          : cmd_rm(args)
-    elif args.command == "show-ref"    : cmd_show_ref(args)
-    elif args.command == "tag"         : cmd_tag(args)
+    args = make_argparser(argv).parse_args(argv)
+
+    perf_setup(args.perf)
+    try:
+        # Subparsers
+        # "cmd_*" functions take the parsed args as parameter and proces and
+        # validate them before executing the command 
+        if   args.command == "add"         : cmd_add(args)
+        elif args.command == "cat-file"    : cmd_cat_file(args)
+        elif args.command == "checkout"    : cmd_checkout(args)
+        elif args.command == "commit-graph": cmd_commit_graph(args)
+        # elif args.command == "commit"      : cmd_commit(args)
+        elif args.command == "diff-tree"   : cmd_diff_tree(args)
+        elif args.command == "fast-import" : cmd_fast_import(args)
+        elif args.command == "fsck"        : cmd_fsck(args)
+        elif args.command == "hash-object" : cmd_hash_object(args)
+        elif args.command == "init"        : cmd_init(args)
+        elif args.command == "log"         : cmd_log(args)
+        elif args.command == "ls-files"    : cmd_ls_files(args)
+        elif args.command == "ls-tree"     : cmd_ls_tree(args)
+        # elif args.command == "merge"       : cmd_merge(args)
+        elif args.command == "merge-base"  : cmd_merge_base(args)
+        elif args.command == "pack-refs"   : cmd_pack_refs(args)
+        # elif args.command == "rebase"      : cmd_rebase(args)
+        elif args.command == "repack"      : cmd_repack(args)
+        elif args.command == "rev-list"    : cmd_rev_list(args)
+        elif args.command == "rev-parse"   : cmd_rev_parse(args)
+        # elif args.command == "rm"          : cmd_rm(args)
+        elif args.command == "show-ref"    : cmd_show_ref(args)
+        elif args.command == "status"      : cmd_status(args)
+        elif args.command == "tag"         : cmd_tag(args)
+    finally:
+        if perf.enabled:
+            perf.flush(args.command)
 
 class Repository(object):
     worktree = None
     gitdir = None
     conf = None
+    # Packfiles found in objects/pack, loaded on first use by repo_packs()
+    packs = None
+    packs_mtime = None
+    # Recently resolved delta bases, shared by all packs of the repository
+    delta_cache = None
+    # objects/info/commit-graph, loaded on first use by repo_commit_graph()
+    commit_graph = None
+    commit_graph_mtime = None
+    # References, see repo_refs()
+    refs = None
+    # Sorted object IDs for prefix lookups, see repo_object_index()
+    object_index = None
+    # Parsed objects recently returned by read_object(), keyed by SHA and
+    # bounded by core.objectCacheSize (32m by default)
+    object_cache = None
+    # zlib level of new objects (core.compression), and whether loose
+    # objects are fsynced before being moved into place (core.fsync)
+    compression = -1
+    fsync_objects = False
+    # Paths of the loose objects written in the current ObjectBatch, or
+    # None
+    object_batch = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -61,6 +126,28 @@ class Repository(object):
             vers = int(self.conf.get("core", "repositoryformatversion"))
             if vers != 0:
                 raise Exception("Unsupported repositoryformatversion %s" % vers)
+        self.delta_cache = LRUCache(
+            config_size(self, "core", "deltaBaseCacheLimit", 16 * 1024 * 1024))
+        self.object_cache = LRUCache(
+            config_size(self, "core", "objectCacheSize", 32 * 1024 * 1024))
+        self.compression = self.conf.getint("core", "compression", fallback=-1)
+        # core.fsync lists what git fsyncs; core.fsyncObjectFiles is
+        # its older, deprecated spelling.
+        fsync = self.conf.get("core", "fsync", fallback="").replace(" ", "").split(",")
+        self.fsync_objects = (
+            bool({"loose-object", "objects", "committed", "added", "all"} & set(fsync)) or
+            self.conf.getboolean("core", "fsyncObjectFiles", fallback=False))
+
+# Read a size such as "512k", "16m" or "1g" from the configuration.
+def config_size(repo, section, key, default):
+    value = repo.conf.get(section, key, fallback=None)
+    if value is None:
+        return default
+    value = value.strip().lower()
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
 
 # Compute path under repo's gitdir.
 def repo_path(repo, *path):
@@ -81,7 +168,8 @@ def repo_dir(repo, *path, mkdir=False):
         else:
             raise Exception("Not a directory %s" % path)
     if mkdir:
-        os.makedirs(path)
+        # Concurrent writers may create it too.
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -118,10 +206,12 @@ def repo_default_config():
     return ret
 
 # PYG INIT
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-argsp.add_argument("path",metavar="directory",
-                    nargs="?",default=".",
-                    help="Repository location.")
+@command("init", help="Initialize a new, empty repository.")
+def args_init(argsp):
+    argsp.add_argument("path",metavar="directory",
+                        nargs="?",default=".",
+                        help="Repository location.")
+
 def cmd_init(args):
     create_repo(args.path)
 # /PYG INIT
@@ -144,7 +234,8 @@ def get_repo(path=".", required=True):
     return get_repo(parent, required)
 
 class Object (object):
-    repo = None
+    __slots__ = ("repo",)
+
     def __init__(self, repo, data=None):
         self.repo=repo
         if data != None:
@@ -162,10 +253,37 @@ class Object (object):
 
 # Read object object_id from Git repository repo.  
 # Return an Object whose exact type depends on the object.
+# Objects are cached per repository and shared between callers, so
+# they must be treated as immutable.
 def read_object(repo, sha):
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        perf.add("object_cache.hits")
+        return obj
+    perf.add("object_cache.misses")
+    fmt, data = read_object_raw(repo, sha)
+    # Pick constructor
+    if   fmt==b'commit' : c=Commit
+    elif fmt==b'tree'   : c=Tree
+    elif fmt==b'tag'    : c=Tag
+    elif fmt==b'blob'   : c=Blob
+    else:
+        raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+    # Call constructor, cache and return object
+    obj = c(repo, data)
+    repo.object_cache.put(sha, obj, len(data))
+    return obj
+
+# Return the (type, data) pair of object sha, looking at loose objects
+# first and then at every packfile.
+def read_object_raw(repo, sha):
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    if path and os.path.isfile(path):
+        with open (path, "rb") as f:
+            compressed = f.read()
+        raw = zlib.decompress(compressed)
+        perf.add("read.bytes", len(compressed))
+        perf.add("inflate.bytes", len(raw))
         # Read object type
         x = raw.find(b' ')
         fmt = raw[0:x]
@@ -174,34 +292,967 @@ def read_object(repo, sha):
         size = int(raw[x:y].decode("ascii"))
         if size != len(raw)-y-1:
             raise Exception("Malformed object {0}: bad length".format(sha))
-        # Pick constructor
-        if   fmt==b'commit' : c=Commit
-        elif fmt==b'tree'   : c=Tree
-        elif fmt==b'tag'    : c=Tag
-        elif fmt==b'blob'   : c=Blob
-        else:
-            raise Exception("Unknown type %s for object %s".format(fmt.decode("ascii"), sha))
-        # Call constructor and return object
-        return c(repo, raw[y+1:])
+        return fmt, raw[y+1:]
+    found = pack_find(repo, bytes.fromhex(sha))
+    if not found:
+        raise Exception("Object {0} not found".format(sha))
+    pack, offset = found
+    return pack.read(offset)
+
+# Return the (type, size) pair of object sha without inflating its data:
+# only the header of a loose object is inflated, and packed objects are
+# described by their entry header (for deltas, the type comes from the
+# base and the size from the first bytes of the delta).
+def read_object_header(repo, sha):
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            header = b''
+            for data in inflate_chunks(lambda: f.read(512), 64):
+                header += data
+                if b'\x00' in header:
+                    break
+        x = header.find(b' ')
+        y = header.find(b'\x00')
+        if x < 0 or y < 0:
+            raise Exception("Malformed object {0}: bad header".format(sha))
+        return header[0:x], int(header[x+1:y].decode("ascii"))
+    found = pack_find(repo, bytes.fromhex(sha))
+    if not found:
+        raise Exception("Object {0} not found".format(sha))
+    pack, offset = found
+    return pack.read_header(offset)
+
+# Objects at most this size are inflated and written in one go; larger
+# ones are processed in chunks of this size.
+STREAM_CHUNK = 1024 * 1024
+
+# Return (type, size, chunks) for object sha, where chunks is an iterator
+# over its data.  Loose objects and whole packed objects are inflated
+# as they are consumed, in chunks of at most chunk_size bytes, so
+# arbitrarily large blobs use constant memory.  Deltas need their base
+# in memory anyway and are produced in one chunk.
+def read_object_stream(repo, sha, chunk_size=STREAM_CHUNK):
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        f = open(path, "rb")
+        chunks = inflate_chunks(lambda: f.read(chunk_size), chunk_size)
+        header = b''
+        for data in chunks:
+            header += data
+            if b'\x00' in header:
+                break
+        x = header.find(b' ')
+        y = header.find(b'\x00')
+        if x < 0 or y < 0:
+            f.close()
+            raise Exception("Malformed object {0}: bad header".format(sha))
+        size = int(header[x+1:y].decode("ascii"))
+        return header[0:x], size, loose_chunks(f, header[y+1:], chunks, size, sha)
+    found = pack_find(repo, bytes.fromhex(sha))
+    if not found:
+        raise Exception("Object {0} not found".format(sha))
+    pack, offset = found
+    return pack.read_stream(offset, chunk_size)
+
+def loose_chunks(f, first, chunks, size, sha):
+    try:
+        total = len(first)
+        if first:
+            yield first
+        for data in chunks:
+            total += len(data)
+            yield data
+        if total != size:
+            raise Exception("Malformed object {0}: bad length".format(sha))
+    finally:
+        f.close()
+
+# Inflate the zlib stream returned piecewise by read(), yielding at most
+# chunk_size bytes at a time.
+def inflate_chunks(read, chunk_size):
+    d = zlib.decompressobj()
+    while not d.eof:
+        raw = d.unconsumed_tail
+        if not raw:
+            raw = read()
+            if not raw:
+                raise Exception("Truncated zlib stream")
+            perf.add("read.bytes", len(raw))
+        data = d.decompress(raw, chunk_size)
+        if data:
+            perf.add("inflate.bytes", len(data))
+            yield data
 
 def get_object(repo, name, fmt=None, follow=True):
     return name
 
 def write_object(obj, actually_write=True):
+    import hashlib
     # Serialize object data
     data = obj.serialize()
     # Add header
     result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
     # Compute hash
     sha = hashlib.sha1(result).hexdigest()
-    if actually_write:
-        # Compute path
-        path=repo_file(obj.repo, "objects", sha[0:2], sha[2:], mkdir=actually_write)
-        with open(path, 'wb') as f:
-            # Compress and write
-            f.write(zlib.compress(result))
+    # An object is never rewritten: it can only have the same content.
+    if actually_write and not object_exists(obj.repo, sha):
+        f, tmp = loose_object_tmp(obj.repo)
+        try:
+            compressed = zlib.compress(result, obj.repo.compression)
+            f.write(compressed)
+        except:
+            f.close()
+            os.unlink(tmp)
+            raise
+        loose_object_commit(obj.repo, f, tmp, sha)
+        perf.add("deflate.bytes", len(result))
+        perf.add("write.bytes", len(compressed))
     return sha
 
+# Loose objects are written to a temporary file in objects/ and renamed
+# into place once complete, so that readers (and concurrent writers of
+# the same object) never see a truncated file.
+def loose_object_tmp(repo):
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+    return os.fdopen(fd, "wb"), tmp
+
+def loose_object_commit(repo, f, tmp, sha):
+    if repo.fsync_objects and repo.object_batch is None:
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+    os.chmod(tmp, 0o444)
+    path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+    os.replace(tmp, path)
+    if repo.object_batch is not None:
+        repo.object_batch.append(path)
+    if repo.object_index:
+        repo.object_index.add(sha)
+
+class ObjectBatch(object):
+    # Within "with ObjectBatch(repo):", loose objects are not fsynced as
+    # they are written: with core.fsync, the objects written and their
+    # directories are all fsynced when the outermost batch ends, by
+    # which time the system has written most of them back already.
+    repo = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.outer = False
+
+    def __enter__(self):
+        self.outer = self.repo.object_batch is None
+        if self.outer:
+            self.repo.object_batch = []
+        return self
+
+    def __exit__(self, *exc):
+        if self.outer:
+            written, self.repo.object_batch = self.repo.object_batch, None
+            if self.repo.fsync_objects:
+                for path in written:
+                    fsync_path(path)
+                # The renames are only durable once their directories are.
+                for path in set(os.path.dirname(p) for p in written):
+                    fsync_path(path)
+        return False
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# True if object sha is in the repository, loose or packed.
+def object_exists(repo, sha):
+    if os.path.isfile(repo_path(repo, "objects", sha[0:2], sha[2:])):
+        return True
+    return pack_find(repo, bytes.fromhex(sha)) is not None
+
+# PYG PACK
+# A packfile holds many objects in one file, each one either stored whole
+# or as a delta against another object.  Its .idx (version 2) maps SHAs to
+# offsets: a 256-entry fanout table counting SHAs by first byte, the sorted
+# SHA table, CRC32s, 32-bit offsets and, for packs over 2GiB, 64-bit ones.
+# Both files are mmap'd, so a lookup costs no system call at all.
+
+PACK_TYPES = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+PACK_KINDS = {v: k for k, v in PACK_TYPES.items()}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+class LRUCache(object):
+    # Least-recently-used cache bounded by the total size of its values,
+    # as given by the caller of put().
+    limit = 0
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # Without count_miss, a miss is not counted: for a probe followed by
+    # a get() that will count it.
+    def get(self, key, count_miss=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.limit:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+# Binary search for binsha in the table of sorted 20-byte SHAs starting
+# at base in m, narrowed down by the fanout table.  Return its position
+# or -1.
+def fanout_search(m, fanout, base, binsha):
+    i = fanout_bisect(m, fanout, base, binsha)
+    pos = base + 20 * i
+    if i < fanout[binsha[0]] and m[pos:pos+20] == binsha:
+        return i
+    return -1
+
+# Return the position where binsha is, or would be inserted, in the table
+# searched by fanout_search().
+def fanout_bisect(m, fanout, base, binsha):
+    first = binsha[0]
+    lo = fanout[first - 1] if first else 0
+    hi = fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = base + 20 * mid
+        if m[pos:pos+20] < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class PackIndex(object):
+    path = None
+    count = 0
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:8] != b'\377tOc\x00\x00\x00\x02':
+            raise Exception("Unsupported pack index {0}".format(path))
+        self.fanout = struct.unpack_from(">256L", self.map, 8)
+        self.count = self.fanout[255]
+        self.sha_base = 8 + 256 * 4
+        self.crc_base = self.sha_base + 20 * self.count
+        self.ofs_base = self.crc_base + 4 * self.count
+        self.ofs64_base = self.ofs_base + 4 * self.count
+
+    # Return the position of the 20-byte binsha in the SHA table, or -1.
+    def find(self, binsha):
+        return fanout_search(self.map, self.fanout, self.sha_base, binsha)
+
+    def sha(self, i):
+        pos = self.sha_base + 20 * i
+        return self.map[pos:pos+20]
+
+    # Return the hex SHAs starting with the hex string prefix.
+    def prefix(self, prefix):
+        i = fanout_bisect(self.map, self.fanout, self.sha_base,
+                          bytes.fromhex(prefix.ljust(40, "0")))
+        ret = []
+        while i < self.count:
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+        return ret
+
+    # Return the hex SHAs immediately before and after the hex sha in
+    # the table, not counting sha itself.
+    def neighbors(self, sha):
+        binsha = bytes.fromhex(sha)
+        i = fanout_bisect(self.map, self.fanout, self.sha_base, binsha)
+        ret = []
+        if i > 0:
+            ret.append(self.sha(i-1).hex())
+        if i < self.count and self.sha(i) == binsha:
+            i += 1
+        if i < self.count:
+            ret.append(self.sha(i).hex())
+        return ret
+
+    def offset(self, i):
+        ofs, = struct.unpack_from(">L", self.map, self.ofs_base + 4 * i)
+        if ofs & 0x80000000:
+            ofs, = struct.unpack_from(">Q", self.map, self.ofs64_base + 8 * (ofs & 0x7fffffff))
+        return ofs
+
+class Pack(object):
+    repo = None
+    path = None
+    index = None
+    # The PackBitmap of the pack, False if it has none, see repo_bitmap()
+    bitmap = None
+
+    def __init__(self, repo, idx_path):
+        self.repo = repo
+        self.index = PackIndex(idx_path)
+        self.path = idx_path[:-4] + ".pack"
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        signature, version, count = struct.unpack_from(">4sLL", self.map, 0)
+        if signature != b'PACK' or version not in (2, 3):
+            raise Exception("Unsupported packfile {0}".format(self.path))
+        if count != self.index.count:
+            raise Exception("Packfile {0} does not match its index".format(self.path))
+
+    # Parse the header of the entry at offset.  Return its type number,
+    # its (inflated) size, the offset of its zlib data and, for deltas,
+    # the base: an offset in this pack for OFS_DELTA, a binary SHA for
+    # REF_DELTA.
+    def entry_header(self, offset):
+        m = self.map
+        c = m[offset]
+        pos = offset + 1
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = m[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if kind == PACK_OFS_DELTA:
+            c = m[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = m[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = offset - rel
+        elif kind == PACK_REF_DELTA:
+            base = m[pos:pos+20]
+            pos += 20
+        return kind, size, pos, base
+
+    def inflate(self, pos, size):
+        # Slice no more than zlib can possibly need for size bytes, so
+        # the decompressor doesn't copy the rest of the pack into
+        # unused_data.
+        d = zlib.decompressobj()
+        start = pos
+        end = pos + size + (size >> 12) + (size >> 14) + 64
+        data = d.decompress(self.view[pos:end])
+        while not d.eof:
+            if end >= len(self.map):
+                raise Exception("Truncated object in {0}".format(self.path))
+            pos, end = end, end + 65536
+            data += d.decompress(self.view[pos:end])
+        if len(data) != size:
+            raise Exception("Malformed object in {0}: bad length".format(self.path))
+        perf.add("read.bytes", min(end, len(self.map)) - start - len(d.unused_data))
+        perf.add("inflate.bytes", size)
+        return data
+
+    # Inflate the whole object whose zlib data starts at pos, chunk by
+    # chunk.  See read_object_stream().
+    def stream(self, pos, chunk_size):
+        end = len(self.map)
+        def read():
+            nonlocal pos
+            raw = self.view[pos:min(pos + chunk_size, end)]
+            pos += len(raw)
+            return raw
+        return inflate_chunks(read, chunk_size)
+
+    # Return (type, size, chunks) for the object at offset.  See
+    # read_object_stream().
+    def read_stream(self, offset, chunk_size):
+        kind, size, pos, base = self.entry_header(offset)
+        if kind in PACK_TYPES and size > chunk_size:
+            return PACK_TYPES[kind], size, self.stream(pos, chunk_size)
+        fmt, data = self.read(offset)
+        return fmt, len(data), iter([data])
+
+    # Return the (type, size) pair of the object at offset.  See
+    # read_object_header().
+    def read_header(self, offset):
+        kind, size, pos, base = self.entry_header(offset)
+        if kind in PACK_TYPES:
+            return PACK_TYPES[kind], size
+        # The delta header holds the base and result sizes.
+        d = zlib.decompressobj()
+        delta = d.decompress(self.view[pos:pos+64], 20)
+        _, i = read_delta_size(delta, 0)
+        size, _ = read_delta_size(delta, i)
+        # Only the type is needed from the base: skip down the chain.
+        while kind == PACK_OFS_DELTA:
+            kind, _, _, base = self.entry_header(base)
+        if kind == PACK_REF_DELTA:
+            return read_object_header(self.repo, base.hex())[0], size
+        return PACK_TYPES[kind], size
+
+    # Read the object at offset and return its (type, data) pair.  Delta
+    # chains are followed iteratively down to a whole object (or a base
+    # found in the delta cache), then deltas are applied going back up.
+    def read(self, offset):
+        cache = self.repo.delta_cache
+        chain = []
+        while True:
+            cached = cache.get((self.path, offset))
+            if cached is not None:
+                perf.add("delta_cache.hits")
+                fmt, data = cached
+                break
+            perf.add("delta_cache.misses")
+            kind, size, pos, base = self.entry_header(offset)
+            if kind in PACK_TYPES:
+                fmt, data = PACK_TYPES[kind], self.inflate(pos, size)
+                if chain:
+                    # Every base of the chain is worth keeping: nearby
+                    # objects are usually deltas against the same bases.
+                    cache.put((self.path, offset), (fmt, data), len(data))
+                break
+            if kind == PACK_OFS_DELTA:
+                chain.append((offset, self.inflate(pos, size)))
+                offset = base
+            elif kind == PACK_REF_DELTA:
+                chain.append((offset, self.inflate(pos, size)))
+                fmt, data = read_object_raw(self.repo, base.hex())
+                break
+            else:
+                raise Exception("Unknown pack entry type {0} in {1}".format(kind, self.path))
+        if chain:
+            for offset, delta in reversed(chain):
+                data = apply_delta(data, delta)
+                cache.put((self.path, offset), (fmt, data), len(data))
+        return fmt, data
+
+def read_delta_size(delta, pos):
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+# Rebuild an object from its base and a git delta: two varint sizes, then
+# "copy" instructions (offset and length into base) and "insert"
+# instructions (literal bytes).
+def apply_delta(base, delta):
+    src_size, pos = read_delta_size(delta, 0)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+    dst_size, pos = read_delta_size(delta, pos)
+    out = []
+    end = len(delta)
+    while pos < end:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            ofs = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    ofs |= delta[pos] << (8 * i)
+                    pos += 1
+            n = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    n |= delta[pos] << (8 * i)
+                    pos += 1
+            if n == 0:
+                n = 0x10000
+            out.append(base[ofs:ofs+n])
+        elif cmd:
+            out.append(delta[pos:pos+cmd])
+            pos += cmd
+        else:
+            raise Exception("Invalid delta instruction")
+    ret = b''.join(out)
+    if len(ret) != dst_size:
+        raise Exception("Delta result size mismatch")
+    return ret
+
+# Return the packs of repo, (re)loading them when objects/pack changed.
+def repo_packs(repo):
+    path = repo_path(repo, "objects", "pack")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if repo.packs is None or mtime != repo.packs_mtime:
+        old = {p.path[:-5] + ".idx": p for p in repo.packs or []}
+        packs = []
+        for f in sorted(os.listdir(path)):
+            if f.endswith(".idx") and os.path.exists(os.path.join(path, f[:-4] + ".pack")):
+                idx = os.path.join(path, f)
+                packs.append(old.get(idx) or Pack(repo, idx))
+        repo.packs = packs
+        repo.packs_mtime = mtime
+    return repo.packs
+
+# Return (pack, offset) for the object with the 20-byte binsha, or None.
+def pack_find(repo, binsha):
+    for pack in repo_packs(repo):
+        i = pack.index.find(binsha)
+        if i >= 0:
+            return pack, pack.index.offset(i)
+    return None
+# /PYG PACK
+
+# PYG REPACK
+# Loose objects are gathered into a single packfile.  Candidate delta bases
+# are found the way git does: objects are sorted by type, then by a hash of
+# the name a tree gives them (so successive versions of one file end up
+# next to each other), then by decreasing size, and each object is tried
+# against the few objects before it in that order.
+
+def loose_objects(repo):
+    # Yield (sha, path) for every loose object of repo.
+    path = repo_dir(repo, "objects")
+    if not path:
+        return
+    for d in os.scandir(path):
+        if len(d.name) != 2 or not d.is_dir():
+            continue
+        for f in os.scandir(d.path):
+            if len(f.name) == 38:
+                yield d.name + f.name, f.path
+
+def encode_pack_header(kind, size):
+    c = (kind << 4) | (size & 15)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return bytes(ret)
+
+def encode_pack_offset(rel):
+    ret = bytearray([rel & 0x7f])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        ret.append(0x80 | (rel & 0x7f))
+        rel >>= 7
+    return bytes(reversed(ret))
+
+class PackWriter(object):
+    # Write a packfile and its index, one object at a time.  The object
+    # count in the header is only known at the end, so the header is
+    # fixed up and the checksum computed by finish().
+    repo = None
+    offset = 0
+
+    def __init__(self, repo):
+        import tempfile
+        self.repo = repo
+        self.dir = repo_dir(repo, "objects", "pack", mkdir=True)
+        fd, self.tmp_path = tempfile.mkstemp(prefix="tmp_pack_", dir=self.dir)
+        self.file = os.fdopen(fd, "w+b")
+        self.file.write(struct.pack(">4sLL", b'PACK', 2, 0))
+        self.offset = 12
+        # binsha -> (offset, crc32)
+        self.entries = dict()
+
+    def __contains__(self, binsha):
+        return binsha in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def write_entry(self, binsha, header, compressed):
+        self.file.write(header)
+        self.file.write(compressed)
+        crc = zlib.crc32(compressed, zlib.crc32(header))
+        self.entries[binsha] = (self.offset, crc)
+        self.offset += len(header) + len(compressed)
+        perf.add("write.bytes", len(header) + len(compressed))
+
+    def add(self, binsha, fmt, data):
+        perf.add("deflate.bytes", len(data))
+        self.write_entry(binsha, encode_pack_header(PACK_KINDS[fmt], len(data)),
+                         zlib.compress(data, self.repo.compression))
+
+    def add_delta(self, binsha, base, delta):
+        # OFS_DELTA when the base is already in this pack, else REF_DELTA
+        if base in self.entries:
+            rel = self.offset - self.entries[base][0]
+            header = encode_pack_header(PACK_OFS_DELTA, len(delta)) + encode_pack_offset(rel)
+        else:
+            header = encode_pack_header(PACK_REF_DELTA, len(delta)) + base
+        perf.add("deflate.bytes", len(delta))
+        self.write_entry(binsha, header, zlib.compress(delta, self.repo.compression))
+
+    # Complete the pack and write its index.  Return the path of the
+    # .pack, or None if nothing was added.
+    def finish(self):
+        import hashlib
+        if not self.entries:
+            self.abort()
+            return None
+        f = self.file
+        f.seek(8)
+        f.write(struct.pack(">L", len(self.entries)))
+        f.seek(0)
+        h = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+        checksum = h.digest()
+        f.write(checksum)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        base = os.path.join(self.dir, "pack-" + checksum.hex())
+        os.chmod(self.tmp_path, 0o444)
+        os.replace(self.tmp_path, base + ".pack")
+        write_pack_index(base + ".idx", self.entries, checksum)
+        return base + ".pack"
+
+    # Read back the whole (non-delta) object binsha written to this pack.
+    def read(self, binsha):
+        offset = self.entries[binsha][0]
+        self.file.flush()
+        fd = self.file.fileno()
+        head = os.pread(fd, 16, offset)
+        c = head[0]
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = 1
+        while c & 0x80:
+            c = head[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        if kind not in PACK_TYPES:
+            raise Exception("Cannot read back delta {0}".format(binsha.hex()))
+        d = zlib.decompressobj()
+        pos += offset
+        data = b''
+        while not d.eof:
+            chunk = os.pread(fd, size + (size >> 12) + 64, pos)
+            if not chunk:
+                raise Exception("Truncated object {0}".format(binsha.hex()))
+            pos += len(chunk)
+            data += d.decompress(chunk)
+        return PACK_TYPES[kind], data
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.tmp_path)
+
+def write_pack_index(path, entries, checksum):
+    import hashlib
+    import tempfile
+    names = sorted(entries)
+    fanout = [0] * 256
+    for n in names:
+        fanout[n[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+    offsets = []
+    large = []
+    for n in names:
+        ofs = entries[n][0]
+        if ofs < 0x80000000:
+            offsets.append(ofs)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(ofs)
+    count = len(names)
+    data = b''.join([
+        b'\377tOc', struct.pack(">L", 2),
+        struct.pack(">256L", *fanout),
+        b''.join(names),
+        struct.pack(">%dL" % count, *[entries[n][1] for n in names]),
+        struct.pack(">%dL" % count, *offsets),
+        struct.pack(">%dQ" % len(large), *large),
+        checksum])
+    data += hashlib.sha1(data).digest()
+    fd, tmp = tempfile.mkstemp(prefix="tmp_idx_", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+
+def encode_delta_size(size):
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return bytes(ret)
+
+def encode_delta_copy(ofs, n):
+    cmd = 0x80
+    args = bytearray()
+    for i in range(4):
+        c = (ofs >> (8 * i)) & 0xff
+        if c:
+            cmd |= 1 << i
+            args.append(c)
+    for i in range(3):
+        c = (n >> (8 * i)) & 0xff
+        if c:
+            cmd |= 0x10 << i
+            args.append(c)
+    return bytes([cmd]) + bytes(args)
+
+DELTA_BLOCK = 16
+# create_delta() runs at Python speed: a target it can't delta costs
+# about 0.1s per candidate at 256KiB, and a repack tries a whole window
+# of them.  Larger objects are stored whole (git's core.bigFileThreshold
+# only lowers this).
+DELTA_MAX_SIZE = 256 * 1024
+
+# Compute a git delta turning base into target, or return None if it
+# would be larger than max_size.  base is indexed by aligned 16-byte
+# blocks; target is scanned for those blocks and every hit is extended
+# in both directions as far as the bytes match.
+def create_delta(base, target, max_size):
+    index = dict()
+    for i in range(len(base) - DELTA_BLOCK, -1, -DELTA_BLOCK):
+        index[base[i:i+DELTA_BLOCK]] = i
+    out = [encode_delta_size(len(base)), encode_delta_size(len(target))]
+    size = len(out[0]) + len(out[1])
+    end = len(target)
+    base_end = len(base)
+    pending = 0
+    i = 0
+    while i + DELTA_BLOCK <= end:
+        ofs = index.get(target[i:i+DELTA_BLOCK])
+        if ofs is None:
+            i += 1
+            continue
+        n = DELTA_BLOCK
+        while i > pending and ofs > 0 and target[i-1] == base[ofs-1]:
+            i -= 1
+            ofs -= 1
+            n += 1
+        while True:
+            k = min(256, end - i - n, base_end - ofs - n)
+            if k > 0 and target[i+n:i+n+k] == base[ofs+n:ofs+n+k]:
+                n += k
+            else:
+                break
+        while i + n < end and ofs + n < base_end and target[i+n] == base[ofs+n]:
+            n += 1
+        size += delta_insert(out, target, pending, i)
+        while n:
+            k = min(n, 0x10000)
+            op = encode_delta_copy(ofs, k)
+            out.append(op)
+            size += len(op)
+            ofs += k
+            i += k
+            n -= k
+        pending = i
+        if size > max_size:
+            return None
+    size += delta_insert(out, target, pending, end)
+    if size > max_size:
+        return None
+    return b''.join(out)
+
+def delta_insert(out, target, start, end):
+    size = 0
+    while start < end:
+        k = min(end - start, 127)
+        out.append(bytes([k]))
+        out.append(target[start:start+k])
+        size += k + 1
+        start += k
+    return size
+
+def pack_name_hash(name):
+    h = 0
+    for c in name:
+        if c in b' \t\n\r\v\f':
+            continue
+        h = ((h >> 2) + (c << 24)) & 0xffffffff
+    return h
+
+@command("repack", help="Pack loose objects.")
+def args_repack(argsp):
+    argsp.add_argument("-a",
+                       action="store_true",
+                       dest="all",
+                       help="Also repack every existing pack into the new one")
+    argsp.add_argument("--window",
+                       type=int,
+                       default=10,
+                       help="Number of objects considered as delta bases")
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=50,
+                       help="Maximum delta chain length")
+    argsp.add_argument("-b", "--write-bitmap-index",
+                       action="store_true",
+                       default=None,
+                       dest="bitmaps",
+                       help="Write a reachability bitmap index (with -a, default: repack.writeBitmaps)")
+
+def cmd_repack(args):
+    repo = get_repo()
+    bitmaps = args.bitmaps
+    if bitmaps is None:
+        bitmaps = repo.conf.getboolean("repack", "writeBitmaps", fallback=False)
+    stats = repack(repo, args.all, args.window, args.depth, bitmaps)
+    if not stats:
+        print("Nothing to pack")
+        return
+    print("Packed {0} objects ({1} deltas) in {2:.2f}s, {3:.0f} objects/s".format(
+        stats["objects"], stats["deltas"], stats["seconds"],
+        stats["objects"] / max(stats["seconds"], 1e-9)))
+    print("{0} bytes before, {1} bytes after, {2} bytes saved".format(
+        stats["before"], stats["after"], stats["before"] - stats["after"]))
+    if stats["bitmaps"]:
+        print("Wrote {0} reachability bitmaps".format(stats["bitmaps"]))
+
+# With bitmaps, also write the bitmap index of the new pack (see PYG
+# BITMAP), which needs it to hold every object: all_packs and no kept
+# pack.
+def repack(repo, all_packs=False, window=10, depth=50, bitmaps=False):
+    start = time.time()
+    loose = dict(loose_objects(repo))
+    shas = set(loose)
+    old_packs = []
+    if bitmaps and not all_packs:
+        print("Not writing bitmaps: only for a repack of all packs (-a)", file=sys.stderr)
+        bitmaps = False
+    if all_packs:
+        for pack in repo_packs(repo):
+            if os.path.exists(pack.path[:-5] + ".keep"):
+                if bitmaps:
+                    print("Not writing bitmaps: {0} is kept".format(pack.path), file=sys.stderr)
+                    bitmaps = False
+                continue
+            old_packs.append(pack)
+            for i in range(pack.index.count):
+                shas.add(pack.index.sha(i).hex())
+    if not shas:
+        return None
+    before = sum(os.path.getsize(p) for p in loose.values())
+    for pack in old_packs:
+        before += os.path.getsize(pack.path) + os.path.getsize(pack.index.path)
+
+    # First pass: type and size of every object, and the names trees
+    # give them.  Data is read again in the second pass, so only the
+    # delta window is ever held in memory.
+    info = []
+    names = dict()
+    for sha in shas:
+        fmt, data = read_object_raw(repo, sha)
+        if fmt == b'tree':
+            for leaf in parse_tree(data):
+                names.setdefault(leaf.sha, leaf.path)
+        info.append((sha, fmt, len(data)))
+    # Names are only known once every tree has been read.
+    info.sort(key=lambda i: (i[1], pack_name_hash(names.get(i[0], b'')), -i[2]))
+
+    threshold = min(config_size(repo, "core", "bigFileThreshold", 512 * 1024 * 1024), DELTA_MAX_SIZE)
+    writer = PackWriter(repo)
+    candidates = collections.deque(maxlen=window)
+    depths = dict()
+    deltas = 0
+    try:
+        for sha, fmt, size in info:
+            _, data = read_object_raw(repo, sha)
+            best = None
+            if 64 <= size <= threshold:
+                max_size = size // 2 - 20
+                for base_sha, base_fmt, base_data in reversed(candidates):
+                    if base_fmt != fmt:
+                        break
+                    if depths.get(base_sha, 0) >= depth:
+                        continue
+                    if size - len(base_data) > max_size:
+                        continue
+                    delta = create_delta(base_data, data, max_size)
+                    if delta is not None:
+                        best = base_sha, delta
+                        max_size = len(delta) - 1
+            binsha = bytes.fromhex(sha)
+            if best:
+                writer.add_delta(binsha, bytes.fromhex(best[0]), best[1])
+                depths[sha] = depths.get(best[0], 0) + 1
+                deltas += 1
+            else:
+                writer.add(binsha, fmt, data)
+            if size <= threshold:
+                candidates.append((sha, fmt, data))
+    except:
+        writer.abort()
+        raise
+    pack_path = writer.finish()
+
+    # The new pack is complete: drop what it replaces.
+    for path in loose.values():
+        os.unlink(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    for pack in old_packs:
+        if pack.path != pack_path:
+            os.unlink(pack.index.path)
+            os.unlink(pack.path)
+        # A bitmap index is only valid for the pack it was written for.
+        if os.path.exists(pack.path[:-5] + ".bitmap"):
+            os.unlink(pack.path[:-5] + ".bitmap")
+    repo.packs = None
+    repo.delta_cache.clear()
+    written = 0
+    if bitmaps:
+        written = bitmap_write(repo, pack_path, {sha: fmt for sha, fmt, _ in info})
+
+    return {
+        "objects": len(info),
+        "deltas": deltas,
+        "bitmaps": written,
+        "seconds": time.time() - start,
+        "before": before,
+        "after": os.path.getsize(pack_path) + os.path.getsize(pack_path[:-5] + ".idx"),
+        "pack": pack_path,
+    }
+# /PYG REPACK
+
 class Blob(Object):
     fmt=b'blob'
     def serialize(self):
@@ -210,44 +1261,128 @@ class Blob(Object):
         self.blobdata = data
 
 # PYG CAT-FILE
-argsp = argsubparsers.add_parser("cat-file",
-                                 help="Provide content of repository objects")
+@command("cat-file",
+         help="Provide content of repository objects")
+def args_cat_file(argsp):
+    argsp.add_argument("-t",
+                       action="store_true",
+                       dest="show_type",
+                       help="Show the object type instead of its content")
+
+    argsp.add_argument("-s",
+                       action="store_true",
+                       dest="show_size",
+                       help="Show the object size instead of its content")
+
+    argsp.add_argument("--batch",
+                       action="store_const",
+                       const="batch",
+                       dest="batch",
+                       help="Print type, size and content of each object named on standard input")
+
+    argsp.add_argument("--batch-check",
+                       action="store_const",
+                       const="batch-check",
+                       dest="batch",
+                       help="Print type and size of each object named on standard input")
 
-argsp.add_argument("type",
-                   metavar="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
+    argsp.add_argument("--buffer",
+                       action="store_true",
+                       help="With --batch, only flush the output at the end")
 
-argsp.add_argument("object",
-                   metavar="object",
-                   help="The object to display")
+    # Both positionals are optional, for -t, -s and --batch: the type is
+    # checked by cmd_cat_file.
+    argsp.add_argument("type",
+                       metavar="type",
+                       nargs="?",
+                       help="Specify the type (blob, commit, tag or tree)")
+
+    argsp.add_argument("object",
+                       metavar="object",
+                       nargs="?",
+                       help="The object to display")
 
 def cmd_cat_file(args):
     repo = get_repo()
-    cat_file(repo, args.object, fmt=args.type.encode())
+    if args.batch:
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+                       contents=args.batch == "batch", flush=not args.buffer)
+    elif args.show_type or args.show_size:
+        name = args.object or args.type
+        if not name:
+            raise Exception("cat-file -t and -s need an object")
+        fmt, size = read_object_header(repo, get_object(repo, name))
+        print(fmt.decode("ascii") if args.show_type else size)
+    elif args.type and args.object:
+        if args.type not in ("blob", "commit", "tag", "tree"):
+            raise Exception("Invalid object type {0}".format(args.type))
+        cat_file(repo, args.object, fmt=args.type.encode())
+    else:
+        raise Exception("cat-file needs a type and an object, -t, -s or --batch")
 
 def cat_file(repo, obj, fmt=None):
-    obj = read_object(repo, get_object(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Serializing an object gives back its stored data, so the data is
+    # streamed as is rather than parsed.
+    _, _, chunks = read_object_stream(repo, get_object(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+
+# For every object name read from inp, one per line, write
+# "<sha> <type> <size>\n" to out, followed with contents by the object
+# data and a newline.  Unknown names give "<name> missing\n", short
+# hashes matching several objects "<name> ambiguous\n"; any other error
+# (a corrupt object, say) is raised.  A single process serves any number
+# of objects, with the repository and its caches shared by all of them.
+def cat_file_batch(repo, inp, out, contents=True, flush=True):
+    for line in inp:
+        name = line.rstrip(b'\r\n')
+        if not name:
+            continue
+        try:
+            found = name.decode("utf-8")
+            if len(found) == 40 and HASH_RE.match(found):
+                found = [found.lower()]
+            else:
+                found = resolve_object(repo, found)
+        except UnicodeDecodeError:
+            found = None
+        if found and len(found) > 1:
+            out.write(name + b' ambiguous\n')
+        elif not found or not object_exists(repo, found[0]):
+            out.write(name + b' missing\n')
+        else:
+            sha = found[0]
+            if contents:
+                fmt, size, chunks = read_object_stream(repo, sha)
+            else:
+                fmt, size = read_object_header(repo, sha)
+            out.write(b'%s %s %d\n' % (sha.encode("ascii"), fmt, size))
+            if contents:
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b'\n')
+        if flush:
+            out.flush()
+    out.flush()
 # /PYG CAT-FILE
 
 # PYG HASH-OBJECT
-argsp = argsubparsers.add_parser("hash-object",help="Compute object ID and optionally creates a blob from a file")
+@command("hash-object",help="Compute object ID and optionally creates a blob from a file")
+def args_hash_object(argsp):
+    argsp.add_argument("-t",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default="blob",
+                       help="Specify the type")
 
-argsp.add_argument("-t",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default="blob",
-                   help="Specify the type")
+    argsp.add_argument("-w",
+                       dest="write",
+                       action="store_true",
+                       help="Actually write the object into the database")
 
-argsp.add_argument("-w",
-                   dest="write",
-                   action="store_true",
-                   help="Actually write the object into the database")
-
-argsp.add_argument("path",
-                   help="Read object from <file>")
+    argsp.add_argument("path",
+                       help="Read object from <file>")
 
 def cmd_hash_object(args):
     if args.write:
@@ -260,6 +1395,9 @@ def cmd_hash_object(args):
         print(sha)
 
 def hash_object(fd, fmt, repo=None):
+    # Blobs need no parsing, so they are never loaded whole.
+    if fmt == b'blob':
+        return hash_object_stream(fd, fmt, repo)
     data = fd.read()
     # Choose constructor depending on
     # object type found in header.
@@ -270,8 +1408,63 @@ def hash_object(fd, fmt, repo=None):
     else:
         raise Exception("Unknown type %s!" % fmt)
     return write_object(obj, repo)
+
+# Hash the rest of file fd as an object of type fmt and, if repo is
+# given, write it.  The size for the header comes from fstat, then the
+# data is hashed and compressed chunk by chunk into a temporary file
+# that is renamed into place once the SHA is known (or dropped, if the
+# object turns out to exist).  Small blobs go through write_object().
+def hash_object_stream(fd, fmt, repo=None):
+    import hashlib
+    size = os.fstat(fd.fileno()).st_size - fd.tell()
+    if repo and fmt == b'blob' and size <= STREAM_CHUNK:
+        # Small enough to hash before compressing, so that an object
+        # already in the repository is not compressed at all.
+        data = fd.read(size + 1)
+        if len(data) != size:
+            raise Exception("{0} changed while being hashed".format(fd.name))
+        return write_object(Blob(repo, data))
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+    out = None
+    if repo:
+        out, tmp = loose_object_tmp(repo)
+        z = zlib.compressobj(repo.compression)
+        out.write(z.compress(header))
+    try:
+        total = 0
+        while True:
+            chunk = fd.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            total += len(chunk)
+            h.update(chunk)
+            if out:
+                out.write(z.compress(chunk))
+        if total != size:
+            raise Exception("{0} changed while being hashed".format(fd.name))
+        sha = h.hexdigest()
+        if out:
+            out.write(z.flush())
+            if object_exists(repo, sha):
+                out.close()
+                os.unlink(tmp)
+            else:
+                perf.add("deflate.bytes", len(header) + size)
+                perf.add("write.bytes", out.tell())
+                loose_object_commit(repo, out, tmp, sha)
+    except:
+        if out:
+            out.close()
+            os.unlink(tmp)
+        raise
+    return sha
 # /PYG HASH-OBJECT
 
+# Parse the headers of a commit or tag, then its message.  Keys map to
+# a value, or to a list of values for repeated keys (parent); the
+# message is under key b'', as a memoryview of raw so that it is not
+# copied.
 def parse_map_with_msg(raw, start=0, dict=None):
     if not dict:
         dict = collections.OrderedDict()
@@ -279,51 +1472,47 @@ def parse_map_with_msg(raw, start=0, dict=None):
         # all calls to the functions will increase the length of the 
         # same dict infinitely 
 
-    # Search for the next space and the next newline.
-    space = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # If space appears before newline, it is a keyword.
+    while True:
+        # Search for the next space and the next newline.
+        space = raw.find(b' ', start)
+        nl = raw.find(b'\n', start)
 
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.
-    if (space < 0) or (nl < space):
-        assert(nl == start)
-        dict[b''] = raw[start+1:]
-        return dict
+        # If newline appears first (or there's no space at all, in which
+        # case find returns -1), we assume a blank line.  A blank line
+        # means the remainder of the data is the message.
+        if (space < 0) or (nl < space):
+            if nl != start:
+                raise Exception("Malformed object headers")
+            dict[b''] = memoryview(raw)[start+1:]
+            return dict
 
-    # Recursive case
-    # ==============
-    # Read a key-value pair and recurse for the next.
-    key = raw[start:space]
+        # If space appears before newline, it is a keyword.
+        key = raw[start:space]
 
-    # Find the end of the value. Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
+        # Find the end of the value. Continuation lines begin with a
+        # space, so we loop until we find a "\n" not followed by a space.
+        end = nl
+        while raw.startswith(b' ', end+1):
+            end = raw.find(b'\n', end+1)
 
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[space+1:end].replace(b'\n ', b'\n')
+        # Grab the value
+        # Also, drop the leading space on continuation lines
+        value = raw[space+1:end]
+        if end != nl:
+            value = value.replace(b'\n ', b'\n')
 
-    # Don't overwrite existing data contents
-    if key in dict:
-        if type(dict[key]) == list:
-            dict[key].append(value)
+        # Don't overwrite existing data contents
+        cur = dict.get(key)
+        if cur is None:
+            dict[key]=value
+        elif type(cur) == list:
+            cur.append(value)
         else:
-            dict[key] = [ dict[key], value ]
-    else:
-        dict[key]=value
-
-    return parse_map_with_msg(raw, start=end+1, dict=dict)
+            dict[key] = [ cur, value ]
+        start = end + 1
 
 def map_with_msg_serialize(map_with_msg):
-    ret = b''
+    ret = []
     # Output fields
     for k in map_with_msg.keys():
         # Skip the message itself
@@ -333,56 +1522,1097 @@ def map_with_msg_serialize(map_with_msg):
         if type(val) != list:
             val = [ val ]
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
-    ret += b'\n' + map_with_msg[b'']
-    return ret
+            ret.append(k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n')
+    ret.append(b'\n')
+    ret.append(map_with_msg[b''])
+    return b''.join(ret)
 
 # PYG COMMIT
 class Commit(Object):
+    # Walks only look at a few headers of many commits, so the raw data is
+    # kept and only parsed as a whole when map_with_msg is first used.
+    # Until then (or until map_with_msg is assigned), serialize()
+    # returns the raw data unchanged.
     fmt=b'commit'
+    __slots__ = ("raw", "fields")
+
+    def __init__(self, repo, data=None):
+        self.raw = None
+        self.fields = None
+        super().__init__(repo, data)
+
     def deserialize(self, data):
-        self.map_with_msg = parse_map_with_msg(data)
+        self.raw = data
+        self.fields = None
+
     def serialize(self):
-        return map_with_msg_serialize(self.map_with_msg)
+        if self.fields is None:
+            return self.raw
+        return map_with_msg_serialize(self.fields)
+
+    @property
+    def map_with_msg(self):
+        if self.fields is None:
+            self.fields = parse_map_with_msg(self.raw) if self.raw is not None else collections.OrderedDict()
+        return self.fields
+
+    @map_with_msg.setter
+    def map_with_msg(self, value):
+        self.fields = value
+        self.raw = None
+
+    # Values of the single-line header key (tree, parent, author,
+    # committer, object, type...), read without parsing the others.
+    def headers(self, key):
+        if self.fields is not None:
+            value = self.fields.get(key, [])
+            return value if type(value) == list else [value]
+        raw = self.raw
+        end = raw.find(b'\n\n')
+        if end < 0:
+            end = len(raw)
+        # Continuation lines start with a space, so "\nkey " can only
+        # be the start of a header.
+        needle = b'\n' + key + b' '
+        n = len(needle)
+        ret = []
+        pos = 0
+        if raw.startswith(needle[1:]):
+            pos = raw.find(b'\n')
+            ret.append(raw[n-1:pos])
+        while True:
+            pos = raw.find(needle, pos, end)
+            if pos < 0:
+                return ret
+            nl = raw.find(b'\n', pos + n)
+            ret.append(raw[pos+n:nl])
+            pos = nl
+
+    def header(self, key):
+        values = self.headers(key)
+        return values[0] if values else None
+
+    # The message, as a memoryview of the raw data (empty if there is no
+    # blank line after the headers)
+    @property
+    def message(self):
+        if self.fields is None:
+            start = self.raw.find(b'\n\n')
+            if start < 0:
+                return memoryview(b'')
+            return memoryview(self.raw)[start + 2:]
+        return self.fields[b'']
+
+    # The first paragraph of the message, on one line.  Only that much
+    # is copied out of the raw data.
+    def subject(self):
+        if self.fields is None:
+            data = self.raw
+            start = data.find(b'\n\n')
+            if start < 0:
+                return b''
+            start += 2
+        else:
+            data = bytes(self.fields[b''])
+            start = 0
+        end = data.find(b'\n\n', start)
+        if end < 0:
+            end = len(data)
+        return data[start:end].replace(b'\n', b' ').strip()
 # /PYG COMMIT
 
 # PYG LOG
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit",
-                   default="HEAD",
-                   nargs="?",
-                   help="Commit to start at.")
+# History is walked by rev_walk(), a generator: commits are produced one
+# at a time, newest first, so that "log -n 20" only reads about 20
+# commits whatever the length of the history.  --topo-order is the
+# exception: no commit can be shown before all its children are, so the
+# whole range is walked first.
+@command("log", help="Display history of a given commit.")
+def args_log(argsp):
+    argsp.add_argument("-n", "--max-count",
+                       type=int,
+                       default=None,
+                       help="Show at most this many commits")
+    argsp.add_argument("--since", "--after",
+                       metavar="date",
+                       default=None,
+                       help="Show commits more recent than date")
+    argsp.add_argument("--until", "--before",
+                       metavar="date",
+                       default=None,
+                       help="Show commits older than date")
+    argsp.add_argument("--topo-order",
+                       action="store_true",
+                       help="Show no parent before all of its children")
+    argsp.add_argument("--format",
+                       choices=["graphviz", "oneline"],
+                       default="graphviz",
+                       help="Output format (default: graphviz)")
+    argsp.add_argument("--oneline",
+                       action="store_const",
+                       const="oneline",
+                       dest="format",
+                       help="Short for --format=oneline")
+    argsp.add_argument("commit",
+                       default=["HEAD"],
+                       nargs="*",
+                       help="Commits to start at (A..B and ^A exclude what A reaches), then paths to limit the history to")
 
 def cmd_log(args):
     repo = get_repo()
+    include = []
+    exclude = []
+    paths = []
+    for name in args.commit:
+        # Whatever follows the first name that isn't a revision is a path.
+        if paths or not (".." in name or name.startswith("^") or resolve_object(repo, name)):
+            paths.append(os.fsencode(name.rstrip("/")))
+        elif ".." in name:
+            a, b = name.split("..", 1)
+            exclude.append(get_commit(repo, a or "HEAD"))
+            include.append(get_commit(repo, b or "HEAD"))
+        elif name.startswith("^"):
+            exclude.append(get_commit(repo, name[1:]))
+        else:
+            include.append(get_commit(repo, name))
+    if not include:
+        include.append(get_commit(repo, "HEAD"))
+    walk = rev_walk(repo, include, exclude,
+                    topo_order=args.topo_order,
+                    since=parse_date(args.since) if args.since else None,
+                    until=parse_date(args.until) if args.until else None,
+                    max_count=args.max_count,
+                    paths=paths)
+    if args.format == "oneline":
+        log_oneline(repo, walk)
+    else:
+        print("digraph pyglog{")
+        log_graphviz(repo, walk)
+        print("}")
+
+def get_commit(repo, name):
+    sha = get_object(repo, name, fmt=b'commit')
+    if not sha:
+        raise Exception("{0} is not a commit".format(name))
+    return sha
 
-    print("digraph pyglog{")
-    log_graphviz(repo, get_object(repo, args.commit), set())
-    print("}")
+# Print as they come, so that output starts before the walk is over.
+def log_graphviz(repo, walk):
+    for sha in walk:
+        for p in commit_info(repo, sha)[0]:
+            print("c_{0} -> c_{1};".format(sha, p), flush=True)
 
-def log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    seen.add(sha)
-    commit = read_object(repo, sha)
-    assert (commit.fmt==b'commit')
-    if not b'parent' in commit.map_with_msg.keys():
-        # Base case: the initial commit.
+def log_oneline(repo, walk):
+    index = repo_object_index(repo)
+    for sha in walk:
+        subject = read_object(repo, sha).subject()
+        print("{0} {1}".format(index.abbrev(sha), subject.decode("utf-8", "replace")), flush=True)
+
+# Return the timestamp of a date given as a timestamp, as an ISO date
+# (local time) such as 2024-01-31 or "2024-01-31 12:30:00", or as
+# "N units ago".
+def parse_date(text):
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    m = DATE_AGO_RE.match(text)
+    if m:
+        return int(time.time()) - int(m.group(1)) * DATE_UNITS[m.group(2)]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(text, fmt)))
+        except ValueError:
+            pass
+    raise Exception("Invalid date {0}".format(text))
+
+DATE_AGO_RE = re.compile(r"^(\d+)[ .](second|minute|hour|day|week|month|year)s?[ .]ago$")
+DATE_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400,
+              "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400}
+
+# Yield the SHAs of the commits reachable from include but not from
+# exclude, newest first (by committer time), or in topological order.
+#
+# Commits come out of a heap ordered by time.  Commits reached from
+# exclude are "uninteresting": they are walked only to mark their
+# parents uninteresting too, and the walk stops once the heap holds
+# nothing else.  As in git, this assumes committer times don't go back
+# in time along history.
+#
+# since stops the walk at the first commit older than it, until hides
+# newer commits, and paths hides the commits that don't change them
+# (and, for merges, follows only a parent they are identical to).
+def rev_walk(repo, include, exclude=(), topo_order=False, since=None, until=None,
+             max_count=None, paths=None):
+    if topo_order:
+        walk = rev_walk(repo, include, exclude, False, since, until, None, paths)
+        walk = rev_topo_sort(repo, list(walk))
+    else:
+        walk = rev_walk_date(repo, include, exclude, since, until, paths)
+    if max_count is None:
+        yield from walk
         return
-    parents = commit.map_with_msg[b'parent']
-    if type(parents) != list:
-        parents = [parents]
+    if max_count > 0:
+        for n, sha in enumerate(walk, 1):
+            yield sha
+            if n >= max_count:
+                return
+
+def rev_walk_date(repo, include, exclude, since, until, paths):
+    heap = []
+    seen = set()
+    uninteresting = set()
+    # Commits in the heap, and how many of them are not uninteresting:
+    # once none is, the walk is over.
+    queued = set()
+    interesting = 0
+    seq = 0
+
+    def push(sha):
+        nonlocal seq, interesting
+        parents, _, when = commit_info(repo, sha)
+        heapq.heappush(heap, (-when, seq, sha, parents))
+        seq += 1
+        queued.add(sha)
+        if sha not in uninteresting:
+            interesting += 1
+
+    # Entries carry the parents of the commit, read along with its time.
+    for sha in list(exclude) + list(include):
+        if sha in seen:
+            continue
+        seen.add(sha)
+        if sha in exclude:
+            uninteresting.add(sha)
+        push(sha)
+
+    while heap:
+        if uninteresting and not interesting:
+            return
+        when, _, sha, parents = heapq.heappop(heap)
+        when = -when
+        queued.discard(sha)
+        if sha in uninteresting:
+            for p in parents:
+                if p not in uninteresting:
+                    uninteresting.add(p)
+                    if p in queued:
+                        interesting -= 1
+                if p not in seen:
+                    seen.add(p)
+                    push(p)
+            continue
+        interesting -= 1
+        if since is not None and when < since:
+            # Everything left in the heap is older still.
+            if not uninteresting:
+                return
+            continue
+        show = until is None or when <= until
+        if paths:
+            show, parents = rev_simplify(repo, sha, parents, paths, show)
+        if show:
+            yield sha
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                push(p)
+
+# Path limiting: return whether commit sha is worth showing (it changes
+# paths), and the parents to follow.  A merge identical to one of its
+# parents under paths is hidden, and only that parent followed.
+def rev_simplify(repo, sha, parents, paths, show):
+    tree = read_object(repo, sha).header(b'tree').decode("ascii")
+    if not parents:
+        return show and any(diff_tree(repo, None, tree, True, paths)), parents
     for p in parents:
-        p = p.decode("ascii")
-        print ("c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+        parent_tree = read_object(repo, p).header(b'tree').decode("ascii")
+        if not any(diff_tree(repo, parent_tree, tree, True, paths)):
+            return False, [p]
+    return show, parents
+
+# Sort shas so that every commit comes before its parents, and each line
+# of history is shown as far as possible before the next one (a stack,
+# as in git).  Commits outside of shas are ignored.
+def rev_topo_sort(repo, shas):
+    parents = {sha: [p for p in commit_info(repo, sha)[0]] for sha in shas}
+    indegree = dict.fromkeys(shas, 0)
+    for sha in shas:
+        for p in parents[sha]:
+            if p in indegree:
+                indegree[p] += 1
+    stack = [sha for sha in reversed(shas) if indegree[sha] == 0]
+    while stack:
+        sha = stack.pop()
+        yield sha
+        for p in parents[sha]:
+            if p in indegree:
+                indegree[p] -= 1
+                if indegree[p] == 0:
+                    stack.append(p)
 # /PYG LOG
 
+# PYG REV-LIST
+# rev-list lists the commits of a walk (see rev_walk()) and, with
+# --objects, everything they reach: the tags given, then the trees and
+# blobs of each commit in turn, each object once.  A tree already
+# listed is not read again, so subtrees shared between commits cost
+# nothing.  As in git, objects reachable from the trees of the excluded
+# commits at the boundary of the walk are left out.  With
+# --use-bitmap-index, the reachability bitmaps of the pack (see PYG
+# BITMAP) replace as much of the walk as they can.
+
+@command("rev-list", help="List commits and, with --objects, the objects they reach.")
+def args_rev_list(argsp):
+    argsp.add_argument("--objects",
+                       action="store_true",
+                       help="Also list the tags given and the trees and blobs of the commits")
+    argsp.add_argument("--count",
+                       action="store_true",
+                       help="Print the number of objects instead of their names")
+    argsp.add_argument("--use-bitmap-index",
+                       action="store_true",
+                       help="Use the reachability bitmaps of the pack, if there are any")
+    argsp.add_argument("rev",
+                       nargs="+",
+                       help="Objects to start at (A..B and ^A exclude what A reaches)")
+
+def cmd_rev_list(args):
+    repo = get_repo()
+    include = []
+    exclude = []
+    for name in args.rev:
+        if ".." in name:
+            a, b = name.split("..", 1)
+            exclude.append(get_object(repo, a or "HEAD"))
+            include.append((get_object(repo, b or "HEAD"), b or "HEAD"))
+        elif name.startswith("^"):
+            exclude.append(get_object(repo, name[1:]))
+        else:
+            include.append((get_object(repo, name), name))
+    if args.use_bitmap_index:
+        found = bitmap_find(repo, [sha for sha, _ in include], exclude, args.objects)
+        if found is not None:
+            bitmap, bits = found
+            if args.count:
+                print(bin(bits).count("1"))
+            else:
+                for sha in bitmap.shas(bits):
+                    print(sha)
+            return
+    count = 0
+    for sha, path in rev_list(repo, include, exclude, args.objects):
+        if args.count:
+            count += 1
+        elif path is None:
+            print(sha)
+        else:
+            print(sha, path.decode("utf-8", "replace"))
+    if args.count:
+        print(count)
+
+# Yield (sha, path) for the commits reachable from include, a list of
+# (sha, name), and not from exclude, with a path of None, then with
+# objects for the tags, trees and blobs: tags and objects given by name
+# get that name, the trees and blobs of commits their path (b'' for the
+# root tree).
+def rev_list(repo, include, exclude=(), objects=False):
+    commits = []
+    pending = []
+    for sha, name in include:
+        fmt = read_object_header(repo, sha)[0]
+        while fmt == b'tag':
+            pending.append((sha, b'tag', os.fsencode(name)))
+            tag = read_object(repo, sha)
+            sha = tag.header(b'object').decode("ascii")
+            fmt = tag.header(b'type')
+        if fmt == b'commit':
+            commits.append(sha)
+        else:
+            pending.append((sha, fmt, os.fsencode(name)))
+    seen = set()
+    excluded = []
+    for sha in exclude:
+        fmt = read_object_header(repo, sha)[0]
+        while fmt == b'tag':
+            tag = read_object(repo, sha)
+            sha = tag.header(b'object').decode("ascii")
+            fmt = tag.header(b'type')
+        if fmt == b'commit':
+            excluded.append(sha)
+        elif objects:
+            for _ in rev_list_tree(repo, sha, fmt, b'', seen):
+                pass
+
+    walked = []
+    for sha in rev_walk(repo, commits, excluded):
+        yield sha, None
+        walked.append(sha)
+    if not objects:
+        return
+    trees = []
+    boundary = set(excluded)
+    listed = set(walked)
+    for sha in walked:
+        commit = read_object(repo, sha)
+        trees.append(commit.header(b'tree').decode("ascii"))
+        boundary.update(p for p in commit_parents(commit) if p not in listed)
+    for sha in boundary:
+        tree = read_object(repo, sha).header(b'tree').decode("ascii")
+        for _ in rev_list_tree(repo, tree, b'tree', b'', seen):
+            pass
+    for sha, fmt, name in pending:
+        yield from rev_list_tree(repo, sha, fmt, name, seen)
+    for tree in trees:
+        yield from rev_list_tree(repo, tree, b'tree', b'', seen)
+
+# Yield (sha, path) for object sha of type fmt at path and, if it is a
+# tree, everything below, depth first, skipping (and adding to) seen.
+def rev_list_tree(repo, sha, fmt, path, seen):
+    stack = [(bytes.fromhex(sha), fmt, path)]
+    while stack:
+        binsha, fmt, path = stack.pop()
+        if binsha in seen:
+            continue
+        seen.add(binsha)
+        yield binsha.hex(), path
+        if fmt == b'tree':
+            prefix = path + b'/' if path else b''
+            entries = []
+            for leaf in read_object(repo, binsha.hex()):
+                kind = mode_type(leaf.mode)
+                # Gitlinks name commits of another repository.
+                if kind != b'commit' and leaf.binsha not in seen:
+                    entries.append((leaf.binsha, kind, prefix + leaf.path))
+            entries.reverse()
+            stack.extend(entries)
+# /PYG REV-LIST
+
+# PYG BITMAP
+# A reachability bitmap index (pack-*.bitmap, git's format version 1)
+# stores, for selected commits of a pack holding everything they reach,
+# the set of objects each one reaches as a bitmap: bit i stands for the
+# i-th object of the pack in offset order.  Bitmaps are EWAH compressed:
+# a sequence of 64-bit marker words, each giving a number of words of
+# all 0 or all 1 bits (bit 0: which, bits 1-32: how many) then a number
+# of literal words that follow it (bits 33-63).  Four more bitmaps give
+# the type of every object, to tell commits (or blobs...) apart.
+#
+# Finding what a set of commits reaches is then a walk from those
+# commits that stops at the first commits with a bitmap, ORing theirs.
+# Bitmaps are decoded into Python ints, on which OR, AND and counting
+# bits are done by C code.
+
+BITMAP_OPT_FULL_DAG = 1
+BITMAP_OPT_HASH_CACHE = 4
+# Besides ref tips, one commit every BITMAP_INTERVAL gets a bitmap.
+BITMAP_INTERVAL = 100
+
+EWAH_RUN_MAX = 0xffffffff
+EWAH_LITERALS_MAX = 0x7fffffff
+EWAH_FULL = 0xffffffffffffffff
+
+def ewah_encode(bits, size):
+    n = (size + 63) // 64
+    words = struct.unpack("<{0}Q".format(n), bits.to_bytes(8 * n, "little"))
+    out = []
+    rlw = 0
+    i = 0
+    while i < n or not out:
+        run_bit = 0
+        run = 0
+        if i < n and words[i] in (0, EWAH_FULL):
+            clean = words[i]
+            run_bit = clean & 1
+            while i < n and words[i] == clean and run < EWAH_RUN_MAX:
+                run += 1
+                i += 1
+        start = i
+        while i < n and words[i] not in (0, EWAH_FULL) and i - start < EWAH_LITERALS_MAX:
+            i += 1
+        rlw = len(out)
+        out.append(run_bit | run << 1 | (i - start) << 33)
+        out.extend(words[start:i])
+    return (struct.pack(">LL", size, len(out)) + struct.pack(">{0}Q".format(len(out)), *out) +
+            struct.pack(">L", rlw))
+
+# Decode the EWAH bitmap at pos in buf.  Return it as an int, and the
+# position that follows it.
+def ewah_decode(buf, pos):
+    size, n = struct.unpack_from(">LL", buf, pos)
+    words = struct.unpack_from(">{0}Q".format(n), buf, pos + 8)
+    out = bytearray()
+    i = 0
+    while i < n:
+        rlw = words[i]
+        run = (rlw >> 1) & EWAH_RUN_MAX
+        literals = rlw >> 33
+        if run:
+            out += (b'\xff' if rlw & 1 else b'\x00') * (8 * run)
+        out += struct.pack("<{0}Q".format(literals), *words[i+1:i+1+literals])
+        i += 1 + literals
+    return int.from_bytes(out, "little"), pos + 12 + 8 * n
+
+# Skip the EWAH bitmap at pos in buf: return the position that follows.
+def ewah_skip(buf, pos):
+    _, n = struct.unpack_from(">LL", buf, pos)
+    return pos + 12 + 8 * n
+
+# Return (order, positions) for pack: the index positions of its
+# objects in offset order, and the other way round.
+def pack_order(pack):
+    index = pack.index
+    offsets = list(struct.unpack_from(">{0}L".format(index.count), index.map, index.ofs_base))
+    for i, ofs in enumerate(offsets):
+        if ofs & 0x80000000:
+            offsets[i] = index.offset(i)
+    order = sorted(range(index.count), key=offsets.__getitem__)
+    positions = array.array("L", bytes(array.array("L").itemsize * index.count))
+    for k, i in enumerate(order):
+        positions[i] = k
+    return order, positions
+
+class PackBitmap(object):
+    pack = None
+    path = None
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = data = f.read()
+        signature, version, flags, count = struct.unpack_from(">4sHHL", data, 0)
+        if signature != b'BITM' or version != 1:
+            raise Exception("Unsupported bitmap index {0}".format(path))
+        if not flags & BITMAP_OPT_FULL_DAG:
+            raise Exception("Bitmap index {0} is not for a full DAG".format(path))
+        if data[12:32] != pack.map[-20:]:
+            raise Exception("Bitmap index {0} does not match its pack".format(path))
+        pos = 32
+        # Commits, trees, blobs and tags
+        self.type_pos = []
+        for _ in range(4):
+            self.type_pos.append(pos)
+            pos = ewah_skip(data, pos)
+        # binsha -> entry number, and (position, XOR offset) of every
+        # entry: its bitmap is to be XORed with that of entry - offset.
+        self.commits = dict()
+        self.entries = []
+        for n in range(count):
+            i, xor, _ = struct.unpack_from(">LBB", data, pos)
+            self.commits[pack.index.sha(i)] = n
+            self.entries.append((pos + 6, xor))
+            pos = ewah_skip(data, pos + 6)
+        self.decoded = dict()
+        self.order, self.positions = pack_order(pack)
+
+    def types(self, fmt):
+        return ewah_decode(self.data, self.type_pos[(b'commit', b'tree', b'blob', b'tag').index(fmt)])[0]
+
+    # The bitmap of commit binsha, or None if it has none.
+    def commit(self, binsha):
+        n = self.commits.get(binsha)
+        return None if n is None else self.entry(n)
+
+    def entry(self, n):
+        bits = self.decoded.get(n)
+        if bits is None:
+            pos, xor = self.entries[n]
+            bits = ewah_decode(self.data, pos)[0]
+            if xor:
+                bits ^= self.entry(n - xor)
+            self.decoded[n] = bits
+        return bits
+
+    # Bit of object binsha, or None if it is not in the pack
+    def position(self, binsha):
+        i = self.pack.index.find(binsha)
+        return self.positions[i] if i >= 0 else None
+
+    # Hex SHAs of the objects in bits, in pack order
+    def shas(self, bits):
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        sha = self.pack.index.sha
+        order = self.order
+        for byte, value in enumerate(data):
+            while value:
+                low = value & -value
+                yield sha(order[8 * byte + low.bit_length() - 1]).hex()
+                value ^= low
+
+# The bitmap index of the first pack that has one, or None.
+def repo_bitmap(repo):
+    for pack in repo_packs(repo):
+        if pack.bitmap is None:
+            path = pack.path[:-5] + ".bitmap"
+            pack.bitmap = PackBitmap(pack, path) if os.path.exists(path) else False
+        if pack.bitmap:
+            return pack.bitmap
+    return None
+
+# Return (bitmap, bits) for the objects reachable from include and not
+# from exclude (lists of SHAs), commits only unless objects, or None if
+# there is no bitmap index or an object is not in its pack.
+def bitmap_find(repo, include, exclude=(), objects=True):
+    bitmap = repo_bitmap(repo)
+    if bitmap is None:
+        return None
+    bits = bitmap_walk(repo, bitmap, include)
+    if bits is None:
+        return None
+    if exclude:
+        excluded = bitmap_walk(repo, bitmap, exclude)
+        if excluded is None:
+            return None
+        bits &= ~excluded
+    if not objects:
+        bits &= bitmap.types(b'commit')
+    return bitmap, bits
+
+# Return the bits of the objects reachable from the SHAs in tips, or
+# None if one of them is not in the pack.  The walk stops at commits
+# that have a bitmap, and at objects already found.
+def bitmap_walk(repo, bitmap, tips):
+    size = (bitmap.pack.index.count + 7) // 8
+    bits = bytearray(size)
+    stack = [(bytes.fromhex(sha), None) for sha in tips]
+    while stack:
+        binsha, fmt = stack.pop()
+        pos = bitmap.position(binsha)
+        if pos is None:
+            return None
+        if bits[pos >> 3] >> (pos & 7) & 1:
+            continue
+        found = bitmap.commit(binsha)
+        if found is not None:
+            bits = bytearray((int.from_bytes(bits, "little") | found).to_bytes(size, "little"))
+            continue
+        bits[pos >> 3] |= 1 << (pos & 7)
+        if fmt == b'blob':
+            continue
+        obj = read_object(repo, binsha.hex())
+        if obj.fmt == b'commit':
+            stack.extend((bytes.fromhex(p.decode("ascii")), b'commit') for p in obj.headers(b'parent'))
+            stack.append((bytes.fromhex(obj.header(b'tree').decode("ascii")), b'tree'))
+        elif obj.fmt == b'tag':
+            stack.append((bytes.fromhex(obj.header(b'object').decode("ascii")), obj.header(b'type')))
+        elif obj.fmt == b'tree':
+            for leaf in obj:
+                kind = mode_type(leaf.mode)
+                if kind != b'commit':
+                    stack.append((leaf.binsha, kind))
+    return int.from_bytes(bits, "little")
+
+# Commits to give a bitmap: the tips of refs and HEAD, and every
+# BITMAP_INTERVAL-th commit of history, oldest first.
+def bitmap_select(repo):
+    tips = []
+    for name, sha in repo_refs(repo).all() + [("HEAD", resolve_ref(repo, "HEAD"))]:
+        if sha and object_exists(repo, sha):
+            sha = get_object(repo, sha, fmt=b'commit')
+            if sha and sha not in tips:
+                tips.append(sha)
+    walk = list(rev_walk(repo, tips))
+    selected = set(tips)
+    selected.update(walk[::BITMAP_INTERVAL])
+    return [sha for sha in reversed(walk) if sha in selected]
+
+# Write the bitmap index of the pack at pack_path, which must hold every
+# object reachable from the selected commits; types maps the hex SHA of
+# every object of the pack to its type.  Return the number of bitmaps.
+def bitmap_write(repo, pack_path, types):
+    import hashlib
+    import tempfile
+    pack = next(p for p in repo_packs(repo) if p.path == pack_path)
+    index = pack.index
+    order, positions = pack_order(pack)
+    count = index.count
+    size = (count + 7) // 8
+
+    kinds = {fmt: bytearray(size) for fmt in (b'commit', b'tree', b'blob', b'tag')}
+    for i in range(count):
+        pos = positions[i]
+        kinds[types[index.sha(i).hex()]][pos >> 3] |= 1 << (pos & 7)
+
+    def position(binsha):
+        i = index.find(binsha)
+        if i < 0:
+            raise Exception("{0} is not in {1}".format(binsha.hex(), pack_path))
+        return positions[i]
+
+    # Each bitmap is found by a walk stopping at the commits given a
+    # bitmap before, older ones first, so that every walk is short.
+    done = dict()
+    entries = []
+    for sha in bitmap_select(repo):
+        bits = bytearray(size)
+        stack = [(bytes.fromhex(sha), b'commit')]
+        while stack:
+            binsha, fmt = stack.pop()
+            pos = position(binsha)
+            if bits[pos >> 3] >> (pos & 7) & 1:
+                continue
+            if binsha in done:
+                found = ewah_decode(done[binsha], 0)[0]
+                bits = bytearray((int.from_bytes(bits, "little") | found).to_bytes(size, "little"))
+                continue
+            bits[pos >> 3] |= 1 << (pos & 7)
+            if fmt == b'commit':
+                commit = read_object(repo, binsha.hex())
+                stack.extend((bytes.fromhex(p), b'commit') for p in commit_parents(commit))
+                stack.append((bytes.fromhex(commit.header(b'tree').decode("ascii")), b'tree'))
+            elif fmt == b'tree':
+                for leaf in read_object(repo, binsha.hex()):
+                    kind = mode_type(leaf.mode)
+                    if kind != b'commit':
+                        stack.append((leaf.binsha, kind))
+        binsha = bytes.fromhex(sha)
+        done[binsha] = ewah_encode(int.from_bytes(bits, "little"), count)
+        entries.append(struct.pack(">LBB", index.find(binsha), 0, 0) + done[binsha])
+
+    data = [b'BITM', struct.pack(">HHL", 1, BITMAP_OPT_FULL_DAG, len(entries)), pack.map[-20:]]
+    for fmt in (b'commit', b'tree', b'blob', b'tag'):
+        data.append(ewah_encode(int.from_bytes(kinds[fmt], "little"), count))
+    data.extend(entries)
+    data = b''.join(data)
+    data += hashlib.sha1(data).digest()
+    fd, tmp = tempfile.mkstemp(prefix="tmp_bitmap_", dir=os.path.dirname(pack_path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, pack_path[:-5] + ".bitmap")
+    pack.bitmap = None
+    return len(entries)
+# /PYG BITMAP
+
+# PYG COMMIT-GRAPH
+# The commit-graph file (objects/info/commit-graph, in git's format)
+# stores for each commit its tree, its parents, its commit time and its
+# generation number, 1 for root commits and 1 + the greatest generation
+# of its parents otherwise.  A commit can only reach commits of a lower
+# generation, which lets ancestry queries stop early.
+#
+# The file is a header, a table of chunks, then the chunks: OIDF (fanout
+# of the SHA table), OIDL (sorted SHAs), CDAT (per commit: tree SHA, two
+# parent positions, generation and time packed in 8 bytes) and EDGE
+# (extra parents of octopus merges).
+
+GRAPH_NO_PARENT = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+GENERATION_MAX = 0x3fffffff
+# Generation of commits missing from the commit-graph
+GENERATION_INFINITY = 0xffffffff
+
+class CommitGraph(object):
+    path = None
+    count = 0
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, chunks, _ = struct.unpack_from(">4sBBBB", self.map, 0)
+        if signature != b'CGPH' or version != 1 or hash_version != 1:
+            raise Exception("Unsupported commit-graph {0}".format(path))
+        offsets = dict()
+        for i in range(chunks):
+            chunk, offset = struct.unpack_from(">4sQ", self.map, 8 + 12 * i)
+            offsets[chunk] = offset
+        for chunk in (b'OIDF', b'OIDL', b'CDAT'):
+            if chunk not in offsets:
+                raise Exception("Missing {0} chunk in {1}".format(chunk.decode(), path))
+        self.fanout = struct.unpack_from(">256L", self.map, offsets[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oid_base = offsets[b'OIDL']
+        self.data_base = offsets[b'CDAT']
+        self.edge_base = offsets.get(b'EDGE')
+
+    # Position of the commit with the 20-byte binsha, or -1.
+    def find(self, binsha):
+        return fanout_search(self.map, self.fanout, self.oid_base, binsha)
+
+    def sha(self, pos):
+        pos = self.oid_base + 20 * pos
+        return self.map[pos:pos+20].hex()
+
+    # Return (tree, parent positions, generation, time) for the commit
+    # at pos.
+    def commit(self, pos):
+        base = self.data_base + 36 * pos
+        tree = self.map[base:base+20].hex()
+        p1, p2, high, low = struct.unpack_from(">LLLL", self.map, base + 20)
+        parents = []
+        if p1 != GRAPH_NO_PARENT:
+            parents.append(p1)
+        if p2 & GRAPH_EXTRA_EDGES:
+            edge = self.edge_base + 4 * (p2 & ~GRAPH_EXTRA_EDGES)
+            while True:
+                p, = struct.unpack_from(">L", self.map, edge)
+                parents.append(p & ~GRAPH_LAST_EDGE)
+                if p & GRAPH_LAST_EDGE:
+                    break
+                edge += 4
+        elif p2 != GRAPH_NO_PARENT:
+            parents.append(p2)
+        return tree, parents, high >> 2, ((high & 3) << 32) | low
+
+# Return the commit-graph of repo, or None if it has none.
+def repo_commit_graph(repo):
+    path = repo_path(repo, "objects", "info", "commit-graph")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        repo.commit_graph = None
+        return None
+    if repo.commit_graph is None or repo.commit_graph_mtime != mtime:
+        repo.commit_graph = CommitGraph(path)
+        repo.commit_graph_mtime = mtime
+    return repo.commit_graph
+
+def commit_parents(commit):
+    return [p.decode("ascii") for p in commit.headers(b'parent')]
+
+def commit_time(commit):
+    # committer is "Name <email> timestamp timezone"
+    return int(commit.header(b'committer').rsplit(b' ', 2)[1])
+
+# Return (parents, generation, time) for commit sha, from the
+# commit-graph if it has the commit, else from the commit object.
+def commit_info(repo, sha):
+    graph = repo_commit_graph(repo)
+    if graph:
+        pos = graph.find(bytes.fromhex(sha))
+        if pos >= 0:
+            _, parents, generation, time = graph.commit(pos)
+            return [graph.sha(p) for p in parents], generation, time
+    commit = read_object(repo, sha)
+    if commit.fmt != b'commit':
+        raise Exception("Not a commit {0}".format(sha))
+    return commit_parents(commit), GENERATION_INFINITY, commit_time(commit)
+
+# Is commit a an ancestor of (or the same as) commit b?
+def is_ancestor(repo, a, b):
+    generation = commit_info(repo, a)[1]
+    # Commits of a lower generation than a cannot reach it.
+    if generation == GENERATION_INFINITY:
+        generation = 0
+    seen = set([b])
+    stack = [b]
+    while stack:
+        sha = stack.pop()
+        if sha == a:
+            return True
+        parents, g, _ = commit_info(repo, sha)
+        if g < generation:
+            continue
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                stack.append(p)
+    return False
+
+# Return the best common ancestors of commits a and b.  Commits are
+# visited from the highest generation (then the most recent) down,
+# marking what each side reaches, until only commits below a common
+# ancestor are left to visit.
+def merge_bases(repo, a, b):
+    if a == b:
+        return [a]
+    info = dict()
+    def get_info(sha):
+        if sha not in info:
+            info[sha] = commit_info(repo, sha)
+        return info[sha]
+    LEFT, RIGHT, STALE = 1, 2, 4
+    flags = {a: LEFT, b: RIGHT}
+    # A commit is queued once, with its flags as they are when popped;
+    # active counts the queued commits not STALE yet: once none is, no
+    # better common ancestor can be found.
+    queue = []
+    queued = set()
+    active = 0
+    # Flags each commit had when last processed
+    done = dict()
+    def push(sha):
+        nonlocal active
+        if sha in queued:
+            return
+        _, generation, time = get_info(sha)
+        heapq.heappush(queue, (-generation, -time, sha))
+        queued.add(sha)
+        if not flags[sha] & STALE:
+            active += 1
+    push(a)
+    push(b)
+    result = []
+    while active:
+        _, _, sha = heapq.heappop(queue)
+        queued.discard(sha)
+        f = flags[sha]
+        if not f & STALE:
+            active -= 1
+        if done.get(sha) == f:
+            continue
+        if f & (LEFT | RIGHT) == LEFT | RIGHT and not f & STALE:
+            result.append(sha)
+            # Ancestors of a common ancestor cannot be best ones.
+            f |= STALE
+            flags[sha] = f
+        done[sha] = f
+        for p in get_info(sha)[0]:
+            pf = flags.get(p, 0)
+            if pf | f != pf:
+                flags[p] = pf | f
+                if p in queued and not pf & STALE and f & STALE:
+                    active -= 1
+                push(p)
+    return [r for r in result
+            if not any(o != r and is_ancestor(repo, r, o) for o in result)]
+
+# Write the commit-graph of every commit reachable from HEAD and refs.
+def commit_graph_write(repo):
+    import hashlib
+    import tempfile
+    store = repo_refs(repo)
+    tips = [store.peeled(name) or sha for name, sha in store.all()]
+    head = resolve_ref(repo, "HEAD")
+    # HEAD has no value on an unborn branch
+    if head:
+        tips.append(head)
+
+    # Peel tags, keep commits
+    starts = []
+    for sha in tips:
+        fmt = read_object_header(repo, sha)[0]
+        while fmt == b'tag':
+            sha = read_object(repo, sha).header(b'object').decode("ascii")
+            fmt = read_object_header(repo, sha)[0]
+        if fmt == b'commit':
+            starts.append(sha)
+
+    commits = dict()
+    stack = starts
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+        commit = read_object(repo, sha)
+        parents = commit_parents(commit)
+        commits[sha] = (commit.header(b'tree').decode("ascii"), parents, commit_time(commit))
+        stack.extend(parents)
+
+    # Generation numbers, parents first
+    generations = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            cur = stack[-1]
+            if cur in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[cur][1] if p not in generations]
+            if pending:
+                stack.extend(pending)
+            else:
+                stack.pop()
+                generations[cur] = min(GENERATION_MAX, 1 + max(
+                    (generations[p] for p in commits[cur][1]), default=0))
+
+    names = sorted(commits)
+    positions = {sha: i for i, sha in enumerate(names)}
+    fanout = [0] * 256
+    for sha in names:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+    data = []
+    edges = []
+    for sha in names:
+        tree, parents, time = commits[sha]
+        parents = [positions[p] for p in parents]
+        p1 = parents[0] if parents else GRAPH_NO_PARENT
+        if len(parents) > 2:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(GRAPH_LAST_EDGE | parents[-1])
+        else:
+            p2 = parents[1] if len(parents) == 2 else GRAPH_NO_PARENT
+        data.append(bytes.fromhex(tree) + struct.pack(">LLLL", p1, p2,
+            (generations[sha] << 2) | ((time >> 32) & 3), time & 0xffffffff))
+
+    chunks = [(b'OIDF', struct.pack(">256L", *fanout)),
+              (b'OIDL', b''.join(bytes.fromhex(sha) for sha in names)),
+              (b'CDAT', b''.join(data))]
+    if edges:
+        chunks.append((b'EDGE', struct.pack(">%dL" % len(edges), *edges)))
+    out = [struct.pack(">4sBBBB", b'CGPH', 1, 1, len(chunks), 0)]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk, body in chunks:
+        out.append(struct.pack(">4sQ", chunk, offset))
+        offset += len(body)
+    out.append(struct.pack(">4sQ", b'\x00\x00\x00\x00', offset))
+    out.extend(body for _, body in chunks)
+    out = b''.join(out)
+    out += hashlib.sha1(out).digest()
+
+    fd, tmp = tempfile.mkstemp(prefix="tmp_graph_", dir=repo_dir(repo, "objects", "info", mkdir=True))
+    with os.fdopen(fd, "wb") as f:
+        f.write(out)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, repo_file(repo, "objects", "info", "commit-graph"))
+    return len(names)
+
+@command("commit-graph", help="Write the commit-graph file.")
+def args_commit_graph(argsp):
+    argsp.add_argument("action",
+                       choices=["write"],
+                       help="What to do with the commit-graph")
+
+def cmd_commit_graph(args):
+    repo = get_repo()
+    print("Wrote {0} commits".format(commit_graph_write(repo)))
+
+@command("merge-base", help="Find common ancestors of two commits.")
+def args_merge_base(argsp):
+    argsp.add_argument("--is-ancestor",
+                       action="store_true",
+                       dest="is_ancestor",
+                       help="Exit with status 0 if the first commit is an ancestor of the second, 1 otherwise")
+    argsp.add_argument("commit1")
+    argsp.add_argument("commit2")
+
+def cmd_merge_base(args):
+    repo = get_repo()
+    a = get_object(repo, args.commit1, fmt=b'commit')
+    b = get_object(repo, args.commit2, fmt=b'commit')
+    if args.is_ancestor:
+        sys.exit(0 if is_ancestor(repo, a, b) else 1)
+    for sha in merge_bases(repo, a, b):
+        print(sha)
+# /PYG COMMIT-GRAPH
+
 class Leaf(object):
-    def __init__(self, mode, path, sha):
+    # Tree entries are numerous: keep them small, and keep their SHA as
+    # the 20 bytes stored in the tree, converting to hex only on demand.
+    __slots__ = ("mode", "path", "binsha")
+
+    def __init__(self, mode, path, sha=None, binsha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.binsha = binsha if binsha is not None else bytes.fromhex(sha)
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+# Type of the object a tree entry points to, as implied by its mode.
+def mode_type(mode):
+    kind = int(mode, 8) & 0o170000
+    if kind == 0o040000:
+        return b'tree'
+    if kind == 0o160000:
+        return b'commit'
+    return b'blob'
 
 def parse_one_node(raw, start=0):
     # Find the space terminator of the mode
@@ -394,15 +2624,8 @@ def parse_one_node(raw, start=0):
     y = raw.find(b'\x00', x)
     # and read the path
     path = raw[x+1:y]
-    # Read the SHA and convert to an hex string
-    sha = hex(
-        int.from_bytes(
-            raw[y+1:y+21], "big"))[2:] # hex() adds 0x in front. Not what is required.
-    # Padding 0 if needed
-    if len(sha) < 40:
-        for _ in range(40 - len(sha)):
-            sha = "0" + sha
-    return y+21, Leaf(mode, path, sha)
+    # The SHA follows, as 20 raw bytes
+    return y+21, Leaf(mode, path, binsha=raw[y+1:y+21])
 
 def parse_tree(raw):
     pos = 0
@@ -413,101 +2636,780 @@ def parse_tree(raw):
         ret.append(data)
     return ret
 
-def serialize_tree(obj):
-    #@FIXME Add serializer!
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        # @FIXME Does
-        ret += sha.to_bytes(20, byteorder="big")
+# Return the positions of the NULL terminating the path of every entry
+# of raw tree data.  Entry i starts right after the SHA that follows
+# entry i-1's NULL.
+def tree_offsets(raw):
+    ret = array.array("L")
+    pos = 0
+    max = len(raw)
+    find = raw.find
+    while pos < max:
+        y = find(b'\x00', pos)
+        if y < 0 or y + 21 > max:
+            raise Exception("Malformed tree: truncated entry")
+        ret.append(y)
+        pos = y + 21
     return ret
 
+def serialize_tree(obj):
+    return b''.join(b'%s %s\x00%s' % (i.mode, i.path, i.binsha) for i in obj.items)
+
 class Tree(Object):
+    # A tree read from the repository keeps its raw data and the offsets
+    # of its entries; Leaf records are only built for entries actually
+    # looked at.  Assigning items replaces the raw data.  Reading them
+    # builds a new list and leaves the tree as it is: trees from
+    # read_object() are shared by every thread.
     fmt=b'tree'
+    raw = None
+    offsets = None
+    leaves = None
+
     def deserialize(self, data):
-        self.items = parse_tree(data)
+        self.raw = data
+        self.offsets = tree_offsets(data)
+        self.leaves = None
+
     def serialize(self):
+        if self.leaves is None and self.raw is not None:
+            return self.raw
         return serialize_tree(self)
 
+    @property
+    def items(self):
+        leaves = self.leaves
+        if leaves is None:
+            return list(self) if self.raw is not None else []
+        return leaves
+
+    @items.setter
+    def items(self, items):
+        self.leaves = items
+        self.raw = self.offsets = None
+
+    def __len__(self):
+        if self.leaves is not None:
+            return len(self.leaves)
+        return len(self.offsets) if self.offsets is not None else 0
+
+    def __getitem__(self, i):
+        if self.leaves is not None:
+            return self.leaves[i]
+        offsets = self.offsets
+        if i < 0:
+            i += len(offsets)
+        start = offsets[i-1] + 21 if i else 0
+        return parse_one_node(self.raw, start)[1]
+
+    def __iter__(self):
+        if self.leaves is not None:
+            return iter(self.leaves)
+        return (self[i] for i in range(len(self.offsets)))
+
+    # Sort key of entry i: trees sort as if their name ended with "/".
+    def key(self, i):
+        if self.leaves is not None:
+            leaf = self.leaves[i]
+            return leaf.path + b'/' if leaf.mode.startswith(b'4') else leaf.path
+        y = self.offsets[i]
+        start = self.offsets[i-1] + 21 if i else 0
+        x = self.raw.find(b' ', start, y)
+        path = self.raw[x+1:y]
+        return path + b'/' if self.raw[start] == ord('4') else path
+
+    # Return the entry named name, or None.  Entries are sorted, so this
+    # is a binary search (two actually: name may be a blob or a tree).
+    def find(self, name):
+        for key in (name, name + b'/'):
+            lo = 0
+            hi = len(self)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                cur = self.key(mid)
+                if cur < key:
+                    lo = mid + 1
+                elif cur > key:
+                    hi = mid
+                else:
+                    return self[mid]
+        return None
+
 # PYG LS-TREE
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
-argsp.add_argument("object",help="The object to show.")
+@command("ls-tree", help="Pretty-print a tree object.")
+def args_ls_tree(argsp):
+    argsp.add_argument("object",help="The object to show.")
 
 def cmd_ls_tree(args):
     repo = get_repo()
     obj = read_object(repo, get_object(repo, args.object, fmt=b'tree'))
-    for item in obj.items:
+    for item in obj:
         print("{0} {1} {2}\t{3}".format(
             "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-            # Disply type of object being pointed to.
-            read_object(repo, item.sha).fmt.decode("ascii"),
+            # Disply type of object being pointed to, as implied by
+            # the mode: entries are never read.
+            mode_type(item.mode).decode("ascii"),
             item.sha,
             item.path.decode("ascii")))
 # /PYG LS-TREE
 
+# PYG DIFF-TREE
+# Two trees are compared by walking their entries side by side, in tree
+# order.  Entries with the same mode, name and SHA are identical and
+# skipped without being parsed, and a subtree with the same SHA on both
+# sides is never read: only the trees on the paths that changed are.
+
+@command("diff-tree", help="Compare the content and mode of two trees.")
+def args_diff_tree(argsp):
+    argsp.add_argument("-r",
+                       action="store_true",
+                       dest="recursive",
+                       help="Recurse into subtrees")
+    argsp.add_argument("--name-only",
+                       action="store_const",
+                       const="name-only",
+                       dest="format",
+                       help="Show only the names of changed files")
+    argsp.add_argument("--name-status",
+                       action="store_const",
+                       const="name-status",
+                       dest="format",
+                       help="Show only the names and status of changed files")
+    argsp.add_argument("object",
+                       nargs="+",
+                       help="Two trees (or commits) to compare, or one commit to compare with its first parent, then paths to limit the comparison to")
+
+def cmd_diff_tree(args):
+    repo = get_repo()
+    # Like git, a single commit is compared with its first parent, and
+    # whatever isn't an object is a path.
+    names = args.object
+    if len(names) > 1 and resolve_object(repo, names[1]):
+        a = get_object(repo, names[0], fmt=b'tree')
+        b = get_object(repo, names[1], fmt=b'tree')
+        paths = names[2:]
+    else:
+        commit = get_object(repo, names[0], fmt=b'commit')
+        if not commit:
+            raise Exception("{0} is not a commit".format(names[0]))
+        parents = commit_parents(read_object(repo, commit))
+        if not parents:
+            return
+        print(commit)
+        a = get_object(repo, parents[0], fmt=b'tree')
+        b = get_object(repo, commit, fmt=b'tree')
+        paths = names[1:]
+    paths = [os.fsencode(p.rstrip("/")) for p in paths]
+    for path, old, new in diff_tree(repo, a, b, args.recursive, paths):
+        status = "A" if old is None else "D" if new is None else "M"
+        name = path.decode("utf-8", "surrogateescape")
+        if args.format == "name-only":
+            print(name)
+        elif args.format == "name-status":
+            print("{0}\t{1}".format(status, name))
+        else:
+            print(":{0:0>6} {1:0>6} {2} {3} {4}\t{5}".format(
+                old.mode.decode("ascii") if old else "0",
+                new.mode.decode("ascii") if new else "0",
+                old.sha if old else "0" * 40,
+                new.sha if new else "0" * 40,
+                status, name))
+
+# Split raw tree data in the raw bytes of its entries.
+def tree_raw_entries(tree):
+    raw = tree.serialize()
+    offsets = tree.offsets if tree.leaves is None else tree_offsets(raw)
+    starts = [0]
+    starts.extend(y + 21 for y in offsets)
+    return [raw[s:y+21] for s, y in zip(starts, offsets)]
+
+# Whether path (a directory if is_dir) is selected by the paths: it is
+# one of them or below one, or (for a directory) leads to one.
+def diff_path_match(path, is_dir, paths):
+    if not paths:
+        return True
+    for p in paths:
+        if path == p or path.startswith(p + b'/'):
+            return True
+        if is_dir and p.startswith(path + b'/'):
+            return True
+    return False
+
+# Yield (path, old, new) for every difference between trees a and b
+# (SHAs, either of which may be None for an empty tree), in path order.
+# old and new are Leaf objects, None for added and deleted entries.  With
+# recursive, subtrees are compared instead of reported; paths limits the
+# comparison to these paths and what is below them.
+def diff_tree(repo, a, b, recursive=False, paths=None, prefix=b''):
+    if a == b:
+        return
+    entries_a = tree_raw_entries(read_object(repo, a)) if a else []
+    entries_b = tree_raw_entries(read_object(repo, b)) if b else []
+    i = j = 0
+    na = len(entries_a)
+    nb = len(entries_b)
+    leaf_a = leaf_b = None
+    while i < na or j < nb:
+        if i < na and j < nb and entries_a[i] == entries_b[j]:
+            i += 1
+            j += 1
+            continue
+        if i < na:
+            leaf_a = parse_one_node(entries_a[i])[1]
+            key_a = leaf_a.path + b'/' if leaf_a.mode == b'40000' else leaf_a.path
+        if j < nb:
+            leaf_b = parse_one_node(entries_b[j])[1]
+            key_b = leaf_b.path + b'/' if leaf_b.mode == b'40000' else leaf_b.path
+        if j >= nb or (i < na and key_a < key_b):
+            old, new = leaf_a, None
+            i += 1
+        elif i >= na or key_b < key_a:
+            old, new = None, leaf_b
+            j += 1
+        else:
+            old, new = leaf_a, leaf_b
+            i += 1
+            j += 1
+        leaf = new or old
+        path = prefix + leaf.path
+        is_tree = leaf.mode == b'40000'
+        if not diff_path_match(path, is_tree, paths):
+            continue
+        if recursive and is_tree:
+            # Same name and both trees, or a tree added or deleted.
+            yield from diff_tree(repo,
+                                 old.sha if old else None,
+                                 new.sha if new else None,
+                                 True, paths, path + b'/')
+        else:
+            yield path, old, new
+# /PYG DIFF-TREE
+
 # PYG CHECKOUT
-argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+@command("checkout", help="Checkout a commit inside of a directory.")
+def args_checkout(argsp):
+    argsp.add_argument("commit",
+                       help="The commit or tree to checkout.")
+    argsp.add_argument("path",
+                       help="The directory to checkout on: empty, the worktree (updated from the index), or the checkout of --from")
+    argsp.add_argument("--from",
+                       metavar="commit",
+                       dest="old",
+                       default=None,
+                       help="The commit or tree checked out in path: only the differences are applied")
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of parallel workers (default: checkout.workers, or 1)")
+    argsp.add_argument("--processes",
+                       action="store_true",
+                       help="Use worker processes instead of threads")
+    argsp.add_argument("-f", "--force",
+                       action="store_true",
+                       help="Overwrite local changes and untracked files in the worktree")
 
 def cmd_checkout(args):
     repo = get_repo()
-    obj = read_object(repo, get_object(repo, args.commit))
-    # If the object is a commit, get its tree
-    if obj.fmt == b'commit':
-        obj = read_object(repo, obj.map_with_msg[b'tree'].decode("ascii"))
+    sha = get_object(repo, args.commit, fmt=b'tree')
+    if not sha:
+        raise Exception("Not a commit or tree {0}!".format(args.commit))
+    jobs = args.jobs
+    if jobs is None:
+        jobs = repo.conf.getint("checkout", "workers", fallback=1)
+    path = os.path.realpath(args.path)
+    if args.old:
+        old = get_object(repo, args.old, fmt=b'tree')
+        if not old:
+            raise Exception("Not a commit or tree {0}!".format(args.old))
+        if not os.path.isdir(path):
+            raise Exception("Not a directory {0}!".format(args.path))
+        checkout_files(repo, diff_tree(repo, old, sha, True), path.encode(), jobs, args.processes)
+        return
+    if path == os.path.realpath(repo.worktree) and os.path.exists(repo_path(repo, "index")):
+        checkout_index(repo, sha, jobs, args.processes, args.force)
+        return
     # Verify that path is an empty directory
-    if os.path.exists(args.path):
-        if not os.path.isdir(args.path):
+    if os.path.exists(path):
+        if not os.path.isdir(path):
             raise Exception("Not a directory {0}!".format(args.path))
-        if os.listdir(args.path):
+        if os.listdir(path):
             raise Exception("Not empty {0}!".format(args.path))
     else:
-        os.makedirs(args.path)
-    checkout_tree(repo, obj, os.path.realpath(args.path).encode())
-
-def checkout_tree(repo, tree, path):
-    for item in tree.items:
-        obj = read_object(repo, item.sha)
-        dest = os.path.join(path, item.path)
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            checkout_tree(repo, obj, dest)
-        elif obj.fmt == b'blob':
+        os.makedirs(path)
+    checkout_tree(repo, read_object(repo, sha), path.encode(), jobs, args.processes)
+
+# Checkout happens in two phases.  The tree is first walked to plan the
+# directories to create and the blobs to write, then, once directories
+# exist, blobs are inflated and written by a pool of workers.  zlib and
+# file I/O release the GIL, so threads already scale; processes avoid
+# it entirely at the cost of each one opening the repository again.
+def checkout_tree(repo, tree, path, jobs=1, processes=False):
+    dirs, files = checkout_plan(repo, tree, path)
+    for d in dirs:
+        os.mkdir(d)
+    checkout_write(repo, files, jobs, processes)
+
+# Write the (dest, sha, mode) blobs of files, whose directories exist.
+def checkout_write(repo, files, jobs=1, processes=False):
+    import concurrent.futures
+    # Blobs are handed to workers in batches, to keep the cost of
+    # scheduling (and, with processes, of pickling) low.
+    batches = [files[i:i+CHECKOUT_BATCH] for i in range(0, len(files), CHECKOUT_BATCH)]
+    if jobs <= 1:
+        results = [checkout_blobs(repo, batch) for batch in batches]
+    elif processes:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(checkout_blobs, [repo.worktree] * len(batches), batches))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            results = list(executor.map(checkout_blobs, [repo] * len(batches), batches))
+    # Every blob is attempted; failures are reported in plan order
+    # whatever the number of workers.
+    errors = [e for batch in results for e in batch]
+    if errors:
+        raise Exception("Checkout failed for {0} files:\n - {1}".format(
+            len(errors), "\n - ".join("{0}: {1}".format(dest.decode(), err) for dest, err in errors)))
+
+CHECKOUT_BATCH = 64
+
+# Return (dirs, files) for checking out tree at path: the directories to
+# create, parents first, and the (dest, sha, mode) of every blob, both
+# in a deterministic depth-first order.
+def checkout_plan(repo, tree, path):
+    dirs = []
+    files = []
+    stack = [(tree, path)]
+    while stack:
+        tree, base = stack.pop()
+        subtrees = []
+        for item in tree:
+            dest = os.path.join(base, item.path)
+            fmt = mode_type(item.mode)
+            if fmt == b'tree':
+                dirs.append(dest)
+                subtrees.append((read_object(repo, item.sha), dest))
+            elif fmt == b'blob':
+                files.append((dest, item.sha, item.mode))
+        stack.extend(reversed(subtrees))
+    return dirs, files
+
+# Update the checkout at path by applying changes, the (name, old, new)
+# triples of diff_tree(): only the files that differ are removed,
+# written or chmod-ed.  Removals come first (so that a file can replace
+# a directory and the other way round), then directories left empty are
+# pruned, then blobs are written by checkout_write().
+def checkout_files(repo, changes, path, jobs=1, processes=False):
+    emptied = set()
+    files = []
+    for name, old, new in changes:
+        dest = os.path.join(path, name)
+        if old is not None and mode_type(old.mode) != b'blob':
+            old = None
+        if new is not None and mode_type(new.mode) != b'blob':
+            new = None
+        if old and new and old.binsha == new.binsha and (old.mode == b'120000') == (new.mode == b'120000'):
+            # Only the executable bit changed
+            st = os.lstat(dest)
+            if new.mode == b'100755':
+                os.chmod(dest, st.st_mode | 0o111)
+            else:
+                os.chmod(dest, st.st_mode & ~0o111)
+            continue
+        if old:
+            try:
+                os.unlink(dest)
+            except FileNotFoundError:
+                pass
+            d = os.path.dirname(dest)
+            while len(d) > len(path) and d not in emptied:
+                emptied.add(d)
+                d = os.path.dirname(d)
+        if new:
+            files.append((dest, new.sha, new.mode))
+    # Deepest first, so that a parent is only tried once empty.
+    for d in sorted(emptied, key=len, reverse=True):
+        try:
+            os.rmdir(d)
+        except OSError:
+            pass
+    for d in sorted(set(os.path.dirname(dest) for dest, _, _ in files)):
+        os.makedirs(d, exist_ok=True)
+    checkout_write(repo, files, jobs, processes)
+    return files
+
+# Switch the worktree of repo to tree sha, taking the index as what is
+# checked out, and record the new content in the index.  Unless force,
+# nothing is touched if a file to update has local changes or an
+# untracked file is in the way.
+def checkout_index(repo, sha, jobs=1, processes=False, force=False):
+    index = read_index(repo)
+    current = {name: (index.mode[i], index.shas[i])
+               for i, name in enumerate(index.names) if not (index.flags[i] >> 12) & 3}
+    target = tree_flatten(repo, sha)
+    changes = []
+    for name in sorted(current.keys() | target.keys()):
+        old = current.get(name)
+        new = target.get(name)
+        if old != new:
+            changes.append((name,
+                            Leaf(b'%o' % old[0], name, binsha=old[1]) if old else None,
+                            Leaf(b'%o' % new[0], name, binsha=new[1]) if new else None))
+    worktree = os.fsencode(os.path.realpath(repo.worktree))
+    if not force:
+        modified, untracked = checkout_conflicts(repo, index, current, changes, worktree, jobs)
+        errors = []
+        if modified:
+            errors.append("Your local changes to the following files would be overwritten by checkout:\n\t" +
+                          "\n\t".join(name.decode("utf-8", "replace") for name in modified))
+        if untracked:
+            errors.append("The following untracked working tree files would be overwritten by checkout:\n\t" +
+                          "\n\t".join(name.decode("utf-8", "replace") for name in untracked))
+        if errors:
+            raise Exception("\n".join(errors) + "\nAborting (use --force to overwrite them)")
+    checkout_files(repo, changes, worktree, jobs, processes)
+    for name, old, new in changes:
+        if new is None:
+            i = index.find(name)
+            while i >= 0:
+                index.remove(i)
+                i = index.find(name)
+        elif mode_type(new.mode) == b'blob':
+            index.set(name, new.binsha, index_stat(os.lstat(os.path.join(worktree, name))))
+    write_index(repo, index)
+
+# Return (modified, untracked), the sorted names of the files changes
+# would lose: tracked files that differ from their index entry, and
+# untracked files at (or in a directory at) the path of a new file or
+# of one of its directories.  As for status, files are only read when
+# their stat data doesn't match the index.
+def checkout_conflicts(repo, index, current, changes, worktree, jobs=1):
+    import concurrent.futures
+    try:
+        index_mtime = os.stat(repo_path(repo, "index")).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+    columns = [getattr(index, field) for field in INDEX_STAT_FIELDS]
+    modified = []
+    untracked = set()
+    suspicious = []
+    for name, old, new in changes:
+        path = os.path.join(worktree, name)
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        if old is not None:
+            if st is None:
+                # Deleted: there is nothing to lose.
+                continue
+            i = index.find(name)
+            values = index_stat(st)
+            if stat.S_ISDIR(st.st_mode) or values[6] != index.mode[i]:
+                modified.append(name)
+            elif (any(c[i] != v for c, v in zip(columns, values)) or
+                  index.mtime_s[i] * 1000000000 + index.mtime_ns[i] >= index_mtime):
+                suspicious.append((name, path, st, index.shas[i]))
+            continue
+        if st is not None:
+            if not stat.S_ISDIR(st.st_mode):
+                untracked.add(name)
+            else:
+                for root, dirs, files in os.walk(path):
+                    # Symlinks to directories are files to git.
+                    files += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                    for f in files:
+                        rel = os.path.join(root, f)[len(worktree) + 1:]
+                        if rel not in current:
+                            untracked.add(rel)
+        i = name.rfind(b'/')
+        while i > 0:
+            parent = name[:i]
+            try:
+                if not stat.S_ISDIR(os.lstat(os.path.join(worktree, parent)).st_mode) and parent not in current:
+                    untracked.add(parent)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            i = name.rfind(b'/', 0, i)
+
+    if suspicious:
+        if jobs <= 1:
+            shas = [hash_worktree_file(path, st) for _, path, st, _ in suspicious]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                shas = list(executor.map(hash_worktree_file,
+                                         [path for _, path, _, _ in suspicious],
+                                         [st for _, _, st, _ in suspicious]))
+        for (name, _, _, binsha), sha in zip(suspicious, shas):
+            if bytes.fromhex(sha) != binsha:
+                modified.append(name)
+    return sorted(modified), sorted(untracked)
+
+# Worker processes open the repository once, on their first batch.
+checkout_worker_repo = None
+
+# Write a batch of blobs and return the (dest, error) of those that
+# failed.  repo is a worktree path when called in a worker process.
+def checkout_blobs(repo, batch):
+    global checkout_worker_repo
+    if isinstance(repo, str):
+        if checkout_worker_repo is None or checkout_worker_repo.worktree != repo:
+            checkout_worker_repo = Repository(repo)
+        repo = checkout_worker_repo
+    errors = []
+    for dest, sha, mode in batch:
+        try:
+            _, _, chunks = read_object_stream(repo, sha)
+            if mode == b'120000':
+                os.symlink(b''.join(chunks), dest)
+                continue
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in chunks:
+                    f.write(chunk)
+            if mode == b'100755':
+                os.chmod(dest, os.stat(dest).st_mode | 0o111)
+        except Exception as e:
+            errors.append((dest, e))
+    return errors
 # /PYG CHECKOUT
 
 # PYG SHOW-REF
+# References live in two places: loose refs, one file per ref under
+# refs/, and packed-refs, a single sorted file of "<sha> <name>" lines,
+# each optionally followed by a "^<sha>" line giving the object an
+# annotated tag points to.  A loose ref overrides a packed one.
+#
+# RefStore caches both per repository.  packed-refs is parsed at once
+# and parsed again only when its stat data changes.  Loose refs are
+# cached per directory and reread when the directory's mtime changes,
+# which every ref update does since refs are written by rename.
+
+class RefStore(object):
+    repo = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.packed_stat = None
+        # Sorted names, with their SHAs and peeled SHAs (or None)
+        self.packed_names = []
+        self.packed_shas = []
+        self.packed_peeled = []
+        # directory -> (mtime, {name: raw value}, [subdirectories])
+        self.dirs = dict()
+
+    def load_packed(self):
+        try:
+            st = os.stat(repo_path(self.repo, "packed-refs"))
+        except FileNotFoundError:
+            self.packed_stat = None
+            self.packed_names, self.packed_shas, self.packed_peeled = [], [], []
+            return
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key == self.packed_stat:
+            return
+        with open(repo_path(self.repo, "packed-refs"), "rb") as f:
+            data = f.read()
+        refs = []
+        for line in data.decode("utf-8").splitlines():
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                refs[-1][2] = line[1:]
+            else:
+                sha, name = line.split(" ", 1)
+                refs.append([name, sha, None])
+        # Sorted files say so in their header, but don't rely on it.
+        refs.sort()
+        self.packed_names = [r[0] for r in refs]
+        self.packed_shas = [r[1] for r in refs]
+        self.packed_peeled = [r[2] for r in refs]
+        self.packed_stat = key
+
+    # Position of name in packed-refs, or -1
+    def packed_find(self, name):
+        self.load_packed()
+        i = bisect.bisect_left(self.packed_names, name)
+        if i < len(self.packed_names) and self.packed_names[i] == name:
+            return i
+        return -1
+
+    # Return {name: raw value} for the loose refs under directory path.
+    def loose(self, path="refs"):
+        full = repo_path(self.repo, path)
+        try:
+            mtime = os.stat(full).st_mtime_ns
+        except FileNotFoundError:
+            return dict()
+        cached = self.dirs.get(path)
+        if cached is None or cached[0] != mtime:
+            files = dict()
+            subdirs = []
+            for entry in os.scandir(full):
+                name = path + "/" + entry.name
+                if entry.is_dir():
+                    subdirs.append(name)
+                elif not entry.name.endswith(".lock"):
+                    with open(entry.path, "r") as f:
+                        files[name] = f.read().strip()
+            cached = (mtime, files, subdirs)
+            self.dirs[path] = cached
+        ret = dict(cached[1])
+        for d in cached[2]:
+            ret.update(self.loose(d))
+        return ret
+
+    # Return the raw value of ref name (a SHA or "ref: <name>"), or None.
+    def read(self, name):
+        try:
+            with open(repo_path(self.repo, name), "r") as f:
+                return f.read().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            pass
+        i = self.packed_find(name)
+        return self.packed_shas[i] if i >= 0 else None
+
+    # Return the SHA ref name points to, following symbolic refs, or None.
+    def resolve(self, name):
+        for _ in range(10):
+            value = self.read(name)
+            if value is None or not value.startswith("ref: "):
+                return value
+            name = value[5:]
+        raise Exception("Too many levels of symbolic references at {0}".format(name))
+
+    # Return the object an annotated tag ref points to, if packed-refs
+    # knows it.
+    def peeled(self, name):
+        if os.path.exists(repo_path(self.repo, name)):
+            return None
+        i = self.packed_find(name)
+        return self.packed_peeled[i] if i >= 0 else None
+
+    # Return every ref under refs/, as a sorted list of (name, sha).
+    def all(self):
+        self.load_packed()
+        values = dict(zip(self.packed_names, self.packed_shas))
+        values.update(self.loose())
+        ret = []
+        for name in sorted(values, key=lambda n: n.split("/")):
+            value = values[name]
+            if value.startswith("ref: "):
+                value = self.resolve(value[5:])
+            if value:
+                ret.append((name, value))
+        return ret
+
+def repo_refs(repo):
+    if repo.refs is None:
+        repo.refs = RefStore(repo)
+    return repo.refs
+
 def resolve_ref(repo, ref):
-    with open(repo_file(repo, ref), 'r') as fp:
-        # Leave out final \n
-        data = fp.read()[:-1]
-    if data.startswith("ref: "):
-        return resolve_ref(repo, data[5:])
-    else:
-        return data
+    if os.path.isabs(ref):
+        ref = os.path.relpath(ref, repo.gitdir)
+    return repo_refs(repo).resolve(ref)
 
-def list_refs(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
+# Return the refs under refs/ as nested OrderedDicts, one per directory.
+def list_refs(repo):
     ret = collections.OrderedDict()
-    # OrderedDict and sort the output of listdir to get sortes refs
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = list_refs(repo, can)
-        else:
-            ret[f] = resolve_ref(repo, can)
+    for name, sha in repo_refs(repo).all():
+        parts = name.split("/")[1:]
+        d = ret
+        for part in parts[:-1]:
+            d = d.setdefault(part, collections.OrderedDict())
+        d[parts[-1]] = sha
     return ret
 
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+# Point ref name (relative to the gitdir, e.g. "refs/heads/master") at sha.
+# The new value is written to name.lock, created exclusively so that
+# concurrent updates fail rather than interleave, then renamed over the
+# ref.
+def update_ref(repo, name, sha):
+    path = repo_path(repo, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock = path + ".lock"
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception("Unable to lock {0}: {1} exists".format(name, lock))
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(sha + "\n")
+        os.replace(lock, path)
+    except:
+        os.unlink(lock)
+        raise
+
+# Move every tag (with all, every ref) into packed-refs, with the peeled
+# value of annotated tags, and remove the loose files.
+def pack_refs(repo, all=False):
+    store = repo_refs(repo)
+    store.load_packed()
+    refs = dict(zip(store.packed_names, store.packed_shas))
+    loose = store.loose()
+    packed = []
+    for name, value in loose.items():
+        if value.startswith("ref: "):
+            continue
+        if all or name.startswith("refs/tags/") or name in refs:
+            refs[name] = value
+            packed.append(name)
+    lines = ["# pack-refs with: peeled fully-peeled sorted \n"]
+    for name in sorted(refs):
+        sha = refs[name]
+        lines.append("{0} {1}\n".format(sha, name))
+        peeled = sha
+        while read_object_header(repo, peeled)[0] == b'tag':
+            peeled = read_object(repo, peeled).header(b'object').decode("ascii")
+        if peeled != sha:
+            lines.append("^{0}\n".format(peeled))
+
+    path = repo_path(repo, "packed-refs")
+    lock = path + ".lock"
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception("Unable to lock packed-refs: {0} exists".format(lock))
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write("".join(lines))
+        os.replace(lock, path)
+    except:
+        os.unlink(lock)
+        raise
+
+    # Drop loose refs now in packed-refs, unless they changed meanwhile.
+    for name in packed:
+        ref_path = repo_path(repo, name)
+        try:
+            with open(ref_path, "r") as f:
+                if f.read().strip() != loose[name]:
+                    continue
+            os.unlink(ref_path)
+        except FileNotFoundError:
+            continue
+        # Remove directories emptied, but keep refs/heads and refs/tags.
+        d = os.path.dirname(ref_path)
+        while len(os.path.relpath(d, repo.gitdir).split(os.sep)) > 2:
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+    return len(refs)
+
+@command("pack-refs", help="Pack refs into packed-refs.")
+def args_pack_refs(argsp):
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Pack every ref, not only tags and already packed refs")
+
+def cmd_pack_refs(args):
+    repo = get_repo()
+    print("Packed {0} refs".format(pack_refs(repo, args.all)))
+
+@command("show-ref", help="List references.")
+def args_show_ref(argsp):
+    pass
 
 def cmd_show_ref(args):
     repo = get_repo()
@@ -528,24 +3430,25 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
 # PYG TAG
 class Tag(Commit):
     fmt = b'tag'
+    __slots__ = ()
 
-argsp = argsubparsers.add_parser(
+@command(
     "tag",
     help="List and create tags")
+def args_tag(argsp):
+    argsp.add_argument("-a",
+                        action="store_true",
+                        dest="create_tag_object",
+                        help="Whether to create a tag object")
 
-argsp.add_argument("-a",
-                    action="store_true",
-                    dest="create_tag_object",
-                    help="Whether to create a tag object")
+    argsp.add_argument("name",
+                        nargs="?",
+                        help="The new tag's name")
 
-argsp.add_argument("name",
-                    nargs="?",
-                    help="The new tag's name")
-
-argsp.add_argument("object",
-                    default="HEAD",
-                    nargs="?",
-                    help="The object the new tag will point to")
+    argsp.add_argument("object",
+                        default="HEAD",
+                        nargs="?",
+                        help="The object the new tag will point to")
 
 def create_tag(repo: Repository, name, reference, create_tag_object):
     # get the GitObject from the object reference
@@ -567,21 +3470,100 @@ def create_tag(repo: Repository, name, reference, create_tag_object):
         create_ref(repo, "tags/" + name, sha)
 
 def create_ref(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    update_ref(repo, "refs/" + ref_name, sha)
 
 def cmd_tag(args):
     repo = get_repo()
 
     if args.name:
-        create_tag(args.name,
+        create_tag(repo,
+                   args.name,
                    args.object,
-                   type="object" if args.create_tag_object else "ref")
+                   args.create_tag_object)
     else:
         refs = list_refs(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        show_ref(repo, refs.get("tags", {}), with_hash=False)
 # /PYG TAG
 
+# PYG OBJECT-INDEX
+# Object IDs, sorted, for resolving and computing abbreviated hashes in
+# O(log n).  Packed objects are already sorted in the .idx files, which
+# are searched in place.  Loose objects are kept as one sorted list per
+# fan-out directory, read again when that directory's mtime changes or
+# pyg itself writes an object there.
+
+LOOSE_RACY_NS = 1000000000
+
+class ObjectIndex(object):
+    repo = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        # fan-out directory name -> (mtime, sorted hex SHAs)
+        self.loose = dict()
+
+    # Sorted SHAs of the loose objects in fan-out directory fanout.  The
+    # directory is stat-ed before it is listed, so that an object added
+    # in between changes the mtime after the one cached.  A directory
+    # changed less than LOOSE_RACY_NS ago may still change within the
+    # same mtime tick: its listing is not kept.
+    def loose_names(self, fanout):
+        path = repo_path(self.repo, "objects", fanout)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self.loose.get(fanout)
+        if cached is None or cached[0] != mtime:
+            names = sorted(fanout + f for f in os.listdir(path) if len(f) == 38)
+            cached = (mtime, names)
+            if time.time_ns() - mtime >= LOOSE_RACY_NS:
+                self.loose[fanout] = cached
+            else:
+                self.loose.pop(fanout, None)
+        return cached[1]
+
+    # Record a loose object just written: its directory is listed again
+    # on next use, with whatever other writers added meanwhile.
+    def add(self, sha):
+        self.loose.pop(sha[0:2], None)
+
+    # Return the sorted SHAs starting with the lowercase hex prefix, which
+    # must be at least 2 characters long.
+    def lookup(self, prefix):
+        ret = set()
+        names = self.loose_names(prefix[0:2])
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            ret.add(names[i])
+            i += 1
+        for pack in repo_packs(self.repo):
+            ret.update(pack.index.prefix(prefix))
+        return sorted(ret)
+
+    # Return the shortest prefix of sha, at least min_length long, that no
+    # other object shares.  Only the objects sorting right before and
+    # right after sha need to be compared.
+    def abbrev(self, sha, min_length=7):
+        length = max(min_length, 4)
+        names = self.loose_names(sha[0:2])
+        i = bisect.bisect_left(names, sha)
+        neighbors = names[max(i-1, 0):i+2]
+        for pack in repo_packs(self.repo):
+            neighbors.extend(pack.index.neighbors(sha))
+        for n in neighbors:
+            if n != sha:
+                length = max(length, len(os.path.commonprefix([sha, n])) + 1)
+        return sha[0:length]
+
+def repo_object_index(repo):
+    if repo.object_index is None:
+        repo.object_index = ObjectIndex(repo)
+    return repo.object_index
+# /PYG OBJECT-INDEX
+
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
 def resolve_object(repo, name):
     # Resolve name to an object hash in repo.
     # This function has records:
@@ -590,30 +3572,28 @@ def resolve_object(repo, name):
     #   - tags
     #   - branches
     #   - remote branches
-    candidates = []
-    hash_regex = re.compile(r"^[0-9A-Fa-f]{1,16}$")
-    short_hash_regex = re.compile(r"^[0-9A-Fa-f]{1,16}$")
     # Abort if string is empty.
     if not name.strip():
         return None
     # Head is nonambiguous
     if name == "HEAD":
-        return [resolve_ref(repo, "HEAD")]
-    if hash_regex.match(name):
+        sha = resolve_ref(repo, "HEAD")
+        return [sha] if sha else []
+    if len(name) != 40:
+        # Refs win over short hashes, in git's order of precedence.
+        refs = repo_refs(repo)
+        for ref in (name, "refs/" + name, "refs/tags/" + name,
+                    "refs/heads/" + name, "refs/remotes/" + name):
+            if ref.startswith("refs/") and refs.read(ref) is not None:
+                sha = refs.resolve(ref)
+                return [sha] if sha else []
+    if HASH_RE.match(name):
         if len(name) == 40:
             # This is a complete hash
             return [ name.lower() ]
-        elif len(name) >= 4:
-            # 4 is the min length for a short hash 
-            name = name.lower()
-            prefix = name[0:2]
-            path = repo_dir(repo, "objects", prefix, mkdir=False)
-            if path:
-                rem = name[2:]
-                for f in os.listdir(path):
-                    if f.startswith(rem):
-                        candidates.append(prefix + f)
-    return candidates
+        # 4 is the min length for a short hash
+        return repo_object_index(repo).lookup(name.lower())
+    return []
 
 def get_object(repo, name, fmt=None, follow=True):
     sha = resolve_object(repo, name)
@@ -625,39 +3605,61 @@ def get_object(repo, name, fmt=None, follow=True):
     if not fmt:
         return sha
     while True:
-        obj = read_object(repo, sha)
-        if obj.fmt == fmt:
+        # Objects are only read if they have to be followed.
+        if read_object_header(repo, sha)[0] == fmt:
             return sha
         if not follow:
             return None
+        obj = read_object(repo, sha)
         # Follow tags
         if obj.fmt == b'tag':
-            sha = obj.map_with_msg[b'object'].decode("ascii")
+            sha = obj.header(b'object').decode("ascii")
         elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.map_with_msg[b'tree'].decode("ascii")
+            sha = obj.header(b'tree').decode("ascii")
         else:
             return None
 
 # PYG REV-PARSE
-argsp = argsubparsers.add_parser(
+@command(
     "rev-parse",
     help="Parse revision (or other objects )identifiers")
+def args_rev_parse(argsp):
+    argsp.add_argument("--wyag-type",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default=None,
+                       help="Specify the expected type")
 
-argsp.add_argument("--wyag-type",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default=None,
-                   help="Specify the expected type")
+    # argparse gives "--short HEAD" HEAD as the length: the name is
+    # optional here so that cmd_rev_parse() can take it back.
+    argsp.add_argument("--short",
+                       metavar="length",
+                       nargs="?",
+                       const="7",
+                       default=None,
+                       help="Print the shortest unique abbreviation, at least length long (--short=length)")
 
-argsp.add_argument("name",
-                   help="The name to parse")
+    argsp.add_argument("name",
+                       nargs="?",
+                       help="The name to parse")
 
 def cmd_rev_parse(args):
+    fmt = None
     if args.type:
         fmt = args.type.encode()
+    name, short = args.name, args.short
+    if name is None:
+        if short is None or short == "7":
+            raise Exception("rev-parse needs a name")
+        name, short = short, "7"
+    if short is not None and not short.isdigit():
+        raise Exception("Invalid --short length {0}".format(short))
     repo = get_repo()
-    print (get_object(repo, args.name, args.type, follow=True))
+    sha = get_object(repo, name, fmt, follow=True)
+    if sha and short:
+        sha = repo_object_index(repo).abbrev(sha, int(short))
+    print (sha)
 
 class Index_Entry(object):
     ctime = None
@@ -687,4 +3689,1436 @@ class Index_Entry(object):
     # Length of the name if < 0xFFF, -1 otherwise
 
     name = None
-                
\ No newline at end of file
+                
+# PYG INDEX
+# The index (.git/index, "DIRC" format versions 2 and 3) lists the files
+# of the staging area, sorted by name, with the stat data they had when
+# last hashed.  Entries are fixed-size records (10 32-bit stat fields,
+# SHA, 16-bit flags, then in version 3 16 more bits of flags if the
+# "extended" flag is set) followed by the name, NUL-padded to a multiple
+# of 8 bytes.  Optional extensions then a SHA-1 of everything before
+# close the file.
+#
+# Large worktrees have hundreds of thousands of entries, so Index stores
+# them column-wise (one array per stat field, a list of raw SHAs, one of
+# names) and only builds Index_Entry objects on request.
+
+INDEX_ENTRY = struct.Struct(">10I20sH")
+INDEX_STAT_FIELDS = ("ctime_s", "ctime_ns", "mtime_s", "mtime_ns", "dev", "ino",
+                     "mode", "uid", "gid", "size")
+INDEX_FLAG_ASSUME_VALID = 0x8000
+INDEX_FLAG_EXTENDED = 0x4000
+# In extended flags: entry recorded by "git add -N"
+INDEX_FLAG_INTENT_TO_ADD = 0x2000
+
+class Index(object):
+    version = 2
+
+    def __init__(self):
+        for field in INDEX_STAT_FIELDS:
+            setattr(self, field, array.array("I"))
+        self.shas = []
+        self.flags = array.array("H")
+        self.extended_flags = array.array("H")
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (self.entry(i) for i in range(len(self.names)))
+
+    # Position of the first entry named name, or -1
+    def find(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return -1
+
+    def entry(self, i):
+        e = Index_Entry()
+        e.ctime = (self.ctime_s[i], self.ctime_ns[i])
+        e.mtime = (self.mtime_s[i], self.mtime_ns[i])
+        e.dev = self.dev[i]
+        e.ino = self.ino[i]
+        e.mode_type = self.mode[i] >> 12
+        e.mode_perms = self.mode[i] & 0o777
+        e.uid = self.uid[i]
+        e.gid = self.gid[i]
+        e.size = self.size[i]
+        e.obj = self.shas[i].hex()
+        flags = self.flags[i]
+        e.flag_assume_valid = bool(flags & INDEX_FLAG_ASSUME_VALID)
+        e.flag_extended = bool(flags & INDEX_FLAG_EXTENDED)
+        e.flag_stage = (flags >> 12) & 3
+        e.flag_name_length = flags & 0xfff if flags & 0xfff != 0xfff else -1
+        e.name = self.names[i]
+        return e
+
+    # Add, or replace, the stage 0 entry for name: binsha with the stat
+    # values returned by index_stat().
+    def set(self, name, binsha, values):
+        i = bisect.bisect_left(self.names, name)
+        # Drop every stage of name, then insert the new entry.
+        while i < len(self.names) and self.names[i] == name:
+            self.remove(i)
+        for field, value in zip(INDEX_STAT_FIELDS, values):
+            getattr(self, field).insert(i, value)
+        self.shas.insert(i, binsha)
+        self.flags.insert(i, min(len(name), 0xfff))
+        self.extended_flags.insert(i, 0)
+        self.names.insert(i, name)
+
+    def remove(self, i):
+        for field in INDEX_STAT_FIELDS:
+            del getattr(self, field)[i]
+        del self.shas[i]
+        del self.flags[i]
+        del self.extended_flags[i]
+        del self.names[i]
+
+# Return the index stat values (see INDEX_STAT_FIELDS) for os.stat
+# result st, truncated to 32 bits like git does.
+def index_stat(st):
+    if stat.S_ISLNK(st.st_mode):
+        mode = 0o120000
+    elif st.st_mode & 0o100:
+        mode = 0o100755
+    else:
+        mode = 0o100644
+    return (st.st_ctime_ns // 1000000000 & 0xffffffff, st.st_ctime_ns % 1000000000,
+            st.st_mtime_ns // 1000000000 & 0xffffffff, st.st_mtime_ns % 1000000000,
+            st.st_dev & 0xffffffff, st.st_ino & 0xffffffff, mode,
+            st.st_uid & 0xffffffff, st.st_gid & 0xffffffff, st.st_size & 0xffffffff)
+
+def parse_index(buf):
+    signature, version, count = struct.unpack_from(">4sII", buf, 0)
+    if signature != b'DIRC':
+        raise Exception("Not an index file")
+    if version not in (2, 3):
+        raise Exception("Unsupported index version {0}".format(version))
+    index = Index()
+    index.version = version
+    # The only per-entry Python work is finding where entries and names
+    # start.  The fixed-size parts are then gathered and converted by
+    # column, with one array per field.
+    starts = []
+    name_starts = []
+    lengths = []
+    extended = dict()
+    pos = 12
+    for i in range(count):
+        flags = (buf[pos+60] << 8) | buf[pos+61]
+        p = pos + 62
+        if flags & INDEX_FLAG_EXTENDED:
+            if version < 3:
+                raise Exception("Extended flags in a version 2 index")
+            extended[i] = struct.unpack_from(">H", buf, p)[0]
+            p += 2
+        n = flags & 0xfff
+        if n == 0xfff:
+            n = buf.find(b'\x00', p) - p
+        starts.append(pos)
+        name_starts.append(p)
+        lengths.append(n)
+        pos += (p - pos + n + 8) & ~7
+    stat = array.array("I", b''.join([buf[s:s+40] for s in starts]))
+    flags = array.array("H", b''.join([buf[s+60:s+62] for s in starts]))
+    if sys.byteorder == "little":
+        stat.byteswap()
+        flags.byteswap()
+    for i, field in enumerate(INDEX_STAT_FIELDS):
+        setattr(index, field, stat[i::len(INDEX_STAT_FIELDS)])
+    index.shas = [buf[s+40:s+60] for s in starts]
+    index.flags = flags
+    index.extended_flags = array.array("H", bytes(2 * count))
+    for i, value in extended.items():
+        index.extended_flags[i] = value
+    index.names = [buf[p:p+n] for p, n in zip(name_starts, lengths)]
+    # Extensions are caches that pyg doesn't maintain: skip them, unless
+    # they are required ones (lowercase signature), which it can't
+    # handle at all.
+    end = len(buf) - 20
+    while pos < end:
+        signature, size = struct.unpack_from(">4sI", buf, pos)
+        if not b'A'[0] <= signature[0] <= b'Z'[0]:
+            raise Exception("Unsupported index extension {0}".format(signature.decode("ascii", "replace")))
+        pos += 8 + size
+    return index
+
+def read_index(repo):
+    import hashlib
+    path = repo_path(repo, "index")
+    if not os.path.exists(path):
+        return Index()
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(buf)
+        ok = hashlib.sha1(view[:-20]).digest() == buf[-20:]
+        view.release()
+        if not ok:
+            raise Exception("Bad index file checksum")
+        return parse_index(buf)
+    finally:
+        buf.close()
+
+# Write index to .git/index, through index.lock
+def write_index(repo, index):
+    import hashlib
+    version = 3 if any(index.extended_flags) else 2
+    pieces = [struct.pack(">4sII", b'DIRC', version, len(index))]
+    pack = INDEX_ENTRY.pack
+    columns = [getattr(index, field) for field in INDEX_STAT_FIELDS]
+    for i, name in enumerate(index.names):
+        extended = index.extended_flags[i]
+        flags = (index.flags[i] & 0xb000) | min(len(name), 0xfff)
+        if extended:
+            flags |= INDEX_FLAG_EXTENDED
+        entry = pack(*[c[i] for c in columns], index.shas[i], flags)
+        if extended:
+            entry += struct.pack(">H", extended)
+        entry += name
+        pieces.append(entry)
+        pieces.append(b'\x00' * (8 - len(entry) % 8))
+    data = b''.join(pieces)
+    data += hashlib.sha1(data).digest()
+
+    path = repo_path(repo, "index")
+    lock = path + ".lock"
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception("Unable to lock the index: {0} exists".format(lock))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(lock, path)
+    except:
+        os.unlink(lock)
+        raise
+
+# Hash the file at path (symlinks as their target), write the blob and
+# return its binary SHA with the stat values to put in the index.
+def index_hash_file(repo, path):
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        sha = write_object(Blob(repo, os.fsencode(os.readlink(path))))
+    else:
+        with open(path, "rb") as f:
+            sha = hash_object_stream(f, b'blob', repo)
+    return bytes.fromhex(sha), index_stat(st)
+
+# Name of worktree file path in the index: relative to the worktree,
+# with / as separator.
+def index_name(repo, path):
+    rel = os.path.relpath(os.path.abspath(path), repo.worktree)
+    if rel == os.curdir:
+        return b''
+    if rel.startswith(os.pardir):
+        raise Exception("{0} is outside the repository".format(path))
+    return os.fsencode(rel.replace(os.sep, "/"))
+
+@command("add", help="Add files contents to the index.")
+def args_add(argsp):
+    argsp.add_argument("path",
+                       nargs="+",
+                       help="Files or directories to add")
+
+def cmd_add(args):
+    repo = get_repo()
+    add(repo, args.path)
+
+def add(repo, paths):
+    index = read_index(repo)
+    files = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d != ".git")
+                files.extend(os.path.join(root, n) for n in sorted(names))
+        elif os.path.lexists(path):
+            files.append(path)
+        else:
+            raise Exception("{0} did not match any file".format(path))
+    try:
+        index_mtime = os.stat(repo_path(repo, "index")).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+    columns = [getattr(index, field) for field in INDEX_STAT_FIELDS]
+    with ObjectBatch(repo):
+        for path in files:
+            name = index_name(repo, path)
+            i = index.find(name)
+            if (i >= 0 and not (index.flags[i] >> 12) & 3 and
+                not index.extended_flags[i] & INDEX_FLAG_INTENT_TO_ADD):
+                # Same stat data as the entry, and not racily clean:
+                # the file wasn't changed since it was added.
+                values = index_stat(os.lstat(path))
+                if (all(c[i] == v for c, v in zip(columns, values)) and
+                    index.mtime_s[i] * 1000000000 + index.mtime_ns[i] < index_mtime):
+                    continue
+            binsha, st = index_hash_file(repo, path)
+            index.set(name, binsha, st)
+    write_index(repo, index)
+
+@command("ls-files", help="Show files in the index.")
+def args_ls_files(argsp):
+    argsp.add_argument("-s", "--stage",
+                       action="store_true",
+                       dest="stage",
+                       help="Show mode, object name and stage of each file")
+
+def cmd_ls_files(args):
+    repo = get_repo()
+    index = read_index(repo)
+    for i, name in enumerate(index.names):
+        if args.stage:
+            print("{0:06o} {1} {2}\t{3}".format(
+                index.mode[i], index.shas[i].hex(), (index.flags[i] >> 12) & 3, name.decode("utf-8")))
+        else:
+            print(name.decode("utf-8"))
+# /PYG INDEX
+
+# PYG STATUS
+# Status compares HEAD with the index (staged changes) and the index with
+# the worktree (unstaged changes, untracked files).  A worktree file is
+# only read when its stat data differs from the one recorded in the
+# index, or when it was modified too close to the index being written
+# for its mtime to be trusted ("racily clean").  Files that must be read
+# are hashed by a pool of threads.
+
+# Return {path: (mode, binsha)} for every non-tree entry under tree sha,
+# with paths prefixed by prefix.
+def tree_flatten(repo, sha, prefix=b''):
+    ret = dict()
+    stack = [(sha, prefix)]
+    while stack:
+        sha, prefix = stack.pop()
+        for item in read_object(repo, sha):
+            if mode_type(item.mode) == b'tree':
+                stack.append((item.sha, prefix + item.path + b'/'))
+            else:
+                ret[prefix + item.path] = (int(item.mode, 8), item.binsha)
+    return ret
+
+# SHA of the tree HEAD points to, or None on an unborn branch
+def head_tree(repo):
+    head = resolve_ref(repo, "HEAD")
+    if not head:
+        return None
+    return read_object(repo, head).header(b'tree').decode("ascii")
+
+# Walk the worktree.  Return {name: lstat result} for files that are in
+# names (index names), and the sorted untracked paths; directories with
+# no tracked file are listed once, with a trailing /, and not entered.
+def scan_worktree(repo, names):
+    tracked_dirs = set()
+    for name in names:
+        i = name.rfind(b'/')
+        while i > 0 and name[:i] not in tracked_dirs:
+            tracked_dirs.add(name[:i])
+            i = name.rfind(b'/', 0, i)
+    found = dict()
+    untracked = []
+    stack = [(os.fsencode(repo.worktree), b'')]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                name = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if name == b'.git':
+                        continue
+                    if name in tracked_dirs:
+                        stack.append((entry.path, name + b'/'))
+                    else:
+                        untracked.append(name + b'/')
+                elif name in names:
+                    found[name] = entry.stat(follow_symlinks=False)
+                else:
+                    untracked.append(name)
+    untracked.sort()
+    return found, untracked
+
+# Hex SHA of the blob worktree file path would be
+def hash_worktree_file(path, st):
+    if stat.S_ISLNK(st.st_mode):
+        return write_object(Blob(None, os.fsencode(os.readlink(path))), False)
+    with open(path, "rb") as f:
+        return hash_object_stream(f, b'blob')
+
+# Return (staged, unstaged, untracked): staged and unstaged are sorted
+# lists of (code, path) with code one of A(dded), M(odified) and
+# D(eleted); untracked is a sorted list of paths.
+def status(repo, jobs=None):
+    import concurrent.futures
+    index = read_index(repo)
+    names = set(index.names)
+
+    staged = []
+    tree = head_tree(repo)
+    head = tree_flatten(repo, tree) if tree else dict()
+    for i, name in enumerate(index.names):
+        if (index.flags[i] >> 12) & 3:
+            # Unmerged entries are only reported once, as stage 0
+            continue
+        if index.extended_flags[i] & INDEX_FLAG_INTENT_TO_ADD:
+            # Only a placeholder: the file is not staged yet.
+            continue
+        if name not in head:
+            staged.append(("A", name))
+        elif head[name] != (index.mode[i], index.shas[i]):
+            staged.append(("M", name))
+    staged.extend(("D", name) for name in head if name not in names)
+    staged.sort(key=lambda s: s[1])
+
+    found, untracked = scan_worktree(repo, names)
+    try:
+        index_mtime = os.stat(repo_path(repo, "index")).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+    columns = [getattr(index, field) for field in INDEX_STAT_FIELDS]
+    unstaged = []
+    suspicious = []
+    for i, name in enumerate(index.names):
+        st = found.get(name)
+        if st is None:
+            unstaged.append(("D", name))
+            continue
+        values = index_stat(st)
+        if index.extended_flags[i] & INDEX_FLAG_INTENT_TO_ADD:
+            unstaged.append(("A", name))
+        elif values[6] != index.mode[i]:
+            unstaged.append(("M", name))
+        elif (any(c[i] != v for c, v in zip(columns, values)) or
+              index.mtime_s[i] * 1000000000 + index.mtime_ns[i] >= index_mtime):
+            suspicious.append((i, name, st))
+
+    refreshed = False
+    if suspicious:
+        worktree = os.fsencode(repo.worktree)
+        paths = [os.path.join(worktree, name) for _, name, _ in suspicious]
+        with perf.timer("status.hash"), concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            shas = list(executor.map(hash_worktree_file, paths, [st for _, _, st in suspicious]))
+        for (i, name, st), sha in zip(suspicious, shas):
+            if bytes.fromhex(sha) != index.shas[i]:
+                unstaged.append(("M", name))
+            elif any(c[i] != v for c, v in zip(columns, index_stat(st))):
+                # Unchanged: record the new stat data, so that the file
+                # is not read next time.
+                for c, v in zip(columns, index_stat(st)):
+                    c[i] = v
+                refreshed = True
+    unstaged.sort(key=lambda s: s[1])
+
+    if refreshed:
+        try:
+            write_index(repo, index)
+        except Exception:
+            # Someone else holds the index lock: the refresh is only an
+            # optimization.
+            pass
+    return staged, unstaged, untracked
+
+@command("status", help="Show the working tree status.")
+def args_status(argsp):
+    argsp.add_argument("-s", "--short",
+                       action="store_true",
+                       help="Give the output in the short format")
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads hashing modified files")
+
+def cmd_status(args):
+    repo = get_repo()
+    staged, unstaged, untracked = status(repo, args.jobs)
+    if args.short:
+        codes = collections.defaultdict(lambda: [" ", " "])
+        for code, name in staged:
+            codes[name][0] = code
+        for code, name in unstaged:
+            codes[name][1] = code
+        for name in sorted(codes):
+            print("{0}{1} {2}".format(codes[name][0], codes[name][1], name.decode("utf-8")))
+        for name in untracked:
+            print("?? {0}".format(name.decode("utf-8")))
+        return
+
+    labels = {"A": "new file:   ", "M": "modified:   ", "D": "deleted:    "}
+    head = repo_refs(repo).read("HEAD")
+    if head and head.startswith("ref: refs/heads/"):
+        print("On branch {0}".format(head[16:]))
+    else:
+        print("HEAD detached at {0}".format(head))
+    for title, changes in (("Changes to be committed:", staged),
+                           ("Changes not staged for commit:", unstaged)):
+        if changes:
+            print("\n" + title)
+            for code, name in changes:
+                print("\t" + labels[code] + name.decode("utf-8"))
+    if untracked:
+        print("\nUntracked files:")
+        for name in untracked:
+            print("\t" + name.decode("utf-8"))
+    if not (staged or unstaged or untracked):
+        print("nothing to commit, working tree clean")
+# /PYG STATUS
+
+# PYG FAST-IMPORT
+# Import history from a git fast-import stream (as written by git
+# fast-export) straight into a single packfile, instead of one loose
+# object per write_object() call.  Objects are hashed and compressed by a
+# pool of threads and appended to the pack in stream order; the tree of
+# each branch is kept in memory and only the directories a commit changed
+# are written again.  Refs are updated once, after the pack and its index
+# are complete.  Supported: blob, commit (with M, D and deleteall), tag,
+# reset, progress, checkpoint, feature, option and done.
+
+@command("fast-import", help="Import a fast-import stream into a packfile.")
+def args_fast_import(argsp):
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads compressing objects")
+    argsp.add_argument("--export-marks",
+                       metavar="file",
+                       help="Write the marks table to file")
+
+def cmd_fast_import(args):
+    repo = get_repo()
+    importer = FastImport(repo, args.jobs)
+    stats = importer.run(sys.stdin.buffer)
+    if args.export_marks:
+        with open(args.export_marks, "w") as f:
+            for mark in sorted(importer.marks):
+                f.write(":{0} {1}\n".format(mark, importer.resolve(importer.marks[mark]).hex()))
+    print("Imported {0} objects ({1} blobs, {2} trees, {3} commits, {4} tags) in {5:.2f}s, {6:.0f} objects/s".format(
+        stats["objects"], stats[b'blob'], stats[b'tree'], stats[b'commit'], stats[b'tag'],
+        stats["seconds"], stats["objects"] / max(stats["seconds"], 1e-9)), file=sys.stderr)
+    print("{0} duplicates, {1} refs updated".format(
+        stats["duplicates"], stats["refs"]), file=sys.stderr)
+
+# Hash and compress one object: return its binary SHA, its pack entry
+# header and its zlib data.
+def pack_encode(fmt, data, level=-1):
+    import hashlib
+    h = hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00')
+    h.update(data)
+    perf.add("deflate.bytes", len(data))
+    return h.digest(), encode_pack_header(PACK_KINDS[fmt], len(data)), zlib.compress(data, level)
+
+# Paths with special characters are C-style quoted by fast-export.
+def unquote_path(path):
+    if path.startswith(b'"') and path.endswith(b'"'):
+        return codecs.escape_decode(path[1:-1])[0]
+    return path
+
+class ImportTree(object):
+    # A directory of a tree being built.  entries maps names to (mode,
+    # binsha) for files, where binsha may still be a pending Future, and
+    # to (0o40000, ImportTree) for directories.  An unchanged directory
+    # only has its sha; entries are read on first change, and sha is
+    # cleared when anything below changes.
+    __slots__ = ("sha", "entries")
+
+    def __init__(self, sha=None, entries=None):
+        self.sha = sha
+        self.entries = entries
+
+class FastImport(object):
+    repo = None
+
+    def __init__(self, repo, jobs=None):
+        import concurrent.futures
+        self.repo = repo
+        jobs = jobs or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        # Objects being encoded, in stream order.  Bounded so that a
+        # slow pack write doesn't buffer the whole stream.
+        self.queue = collections.deque()
+        self.limit = 4 * jobs
+        self.writer = None
+        # mark number -> binsha (or Future of pack_encode())
+        self.marks = dict()
+        # ref -> [commit binsha or None, ImportTree]
+        self.branches = dict()
+        # commit binsha -> tree binsha, for commits of this stream
+        self.commit_trees = dict()
+        self.stats = collections.Counter()
+        self.stream = None
+        self.peeked = None
+        self.existing = True
+
+    def run(self, stream):
+        start = time.time()
+        self.stream = stream
+        # Into an empty repository (the usual case) there is no need to
+        # look for every object before writing it.
+        self.existing = bool(repo_packs(self.repo)) or any(True for _ in loose_objects(self.repo))
+        self.writer = PackWriter(self.repo)
+        try:
+            while True:
+                line = self.line()
+                if line is None or line == b'done':
+                    break
+                cmd, _, arg = line.partition(b' ')
+                if cmd == b'blob':
+                    self.blob()
+                elif cmd == b'commit':
+                    self.commit(arg)
+                elif cmd == b'tag':
+                    self.tag(arg)
+                elif cmd == b'reset':
+                    self.reset(arg)
+                elif cmd == b'progress':
+                    print(line.decode("utf-8", "replace"))
+                elif cmd in (b'checkpoint', b'feature', b'option'):
+                    pass
+                else:
+                    raise Exception("Unsupported fast-import command: {0}".format(line.decode("utf-8", "replace")))
+            self.drain(True)
+        except:
+            self.executor.shutdown(cancel_futures=True)
+            self.writer.abort()
+            raise
+        self.executor.shutdown()
+        self.writer.finish()
+        self.repo.packs = None
+
+        # The objects are all in place: now the refs can point at them.
+        for ref, (sha, _) in sorted(self.branches.items()):
+            if sha is not None:
+                update_ref(self.repo, ref.decode("utf-8"), sha.hex())
+                self.stats["refs"] += 1
+        self.stats["seconds"] = time.time() - start
+        return self.stats
+
+    # Next non-empty line of the stream without its LF, or None at the end.
+    def line(self):
+        if self.peeked is not None:
+            line, self.peeked = self.peeked, None
+            return line
+        while True:
+            line = self.stream.readline()
+            if not line:
+                return None
+            line = line.rstrip(b'\n')
+            if line and not line.startswith(b'#'):
+                return line
+
+    def unread(self, line):
+        self.peeked = line
+
+    # Read the optional lines starting with one of keys.  Return them as
+    # a dict and the first line that doesn't.
+    def fields(self, *keys):
+        ret = dict()
+        line = self.line()
+        while line is not None:
+            key, _, value = line.partition(b' ')
+            if key not in keys:
+                break
+            ret[key] = value
+            line = self.line()
+        return ret, line
+
+    # Read the data command in line: "data <count>" followed by exactly
+    # count bytes, or "data <<delim" followed by lines up to delim.
+    def data(self, line):
+        if line is None or not line.startswith(b'data '):
+            raise Exception("Expected data command, got {0}".format(line))
+        arg = line[5:]
+        if arg.startswith(b'<<'):
+            delim = arg[2:] + b'\n'
+            parts = []
+            for l in iter(self.stream.readline, b''):
+                if l == delim:
+                    return b''.join(parts)
+                parts.append(l)
+            raise Exception("Unterminated data, expected {0}".format(delim))
+        n = int(arg)
+        data = self.stream.read(n)
+        if len(data) != n:
+            raise Exception("Truncated data: expected {0} bytes, got {1}".format(n, len(data)))
+        return data
+
+    # Queue an object for encoding, and return the Future of its
+    # pack_encode() result.
+    def store(self, fmt, data):
+        future = self.executor.submit(pack_encode, fmt, data, self.repo.compression)
+        self.queue.append(future)
+        self.stats[fmt] += 1
+        self.drain()
+        return future
+
+    # Append the encoded objects at the head of the queue to the pack,
+    # waiting for them if the queue is full (or with block, for all of
+    # them).  Objects already in the pack or the repository are skipped.
+    def drain(self, block=False):
+        queue = self.queue
+        while queue and (block or len(queue) > self.limit or queue[0].done()):
+            binsha, header, compressed = queue.popleft().result()
+            if binsha in self.writer or (self.existing and object_exists(self.repo, binsha.hex())):
+                self.stats["duplicates"] += 1
+                continue
+            self.writer.write_entry(binsha, header, compressed)
+            self.stats["objects"] += 1
+
+    def resolve(self, sha):
+        import concurrent.futures
+        if isinstance(sha, concurrent.futures.Future):
+            return sha.result()[0]
+        return sha
+
+    # Return (fmt, data) of binsha, which may be in the pack being written.
+    def read(self, binsha):
+        if binsha not in self.writer:
+            self.drain(True)
+        if binsha in self.writer:
+            return self.writer.read(binsha)
+        return read_object_raw(self.repo, binsha.hex())
+
+    def mark(self, value):
+        if not value.startswith(b':'):
+            raise Exception("Invalid mark {0}".format(value.decode("utf-8", "replace")))
+        return int(value[1:])
+
+    # A data reference of M: a mark or a full SHA.
+    def dataref(self, ref):
+        if ref.startswith(b':'):
+            mark = self.mark(ref)
+            if mark not in self.marks:
+                raise Exception("Unknown mark {0}".format(ref.decode()))
+            return self.marks[mark]
+        return bytes.fromhex(ref.decode("ascii"))
+
+    # A commit-ish of from, merge and tag: a mark, a branch of this
+    # stream, a full SHA or a ref of the repository.
+    def commitish(self, ref):
+        if ref.startswith(b':'):
+            return self.resolve(self.dataref(ref))
+        branch = self.branches.get(ref)
+        if branch and branch[0] is not None:
+            return branch[0]
+        if len(ref) == 40 and HASH_RE.match(ref.decode("ascii", "replace")):
+            return bytes.fromhex(ref.decode("ascii"))
+        sha = resolve_ref(self.repo, ref.decode("utf-8"))
+        if not sha:
+            raise Exception("Not a valid commit: {0}".format(ref.decode("utf-8", "replace")))
+        return bytes.fromhex(sha)
+
+    def commit_tree(self, binsha):
+        if binsha not in self.commit_trees:
+            fmt, data = self.read(binsha)
+            if fmt != b'commit' or not data.startswith(b'tree '):
+                raise Exception("Not a commit: {0}".format(binsha.hex()))
+            self.commit_trees[binsha] = bytes.fromhex(data[5:45].decode("ascii"))
+        return self.commit_trees[binsha]
+
+    def blob(self):
+        fields, line = self.fields(b'mark', b'original-oid')
+        future = self.store(b'blob', self.data(line))
+        if b'mark' in fields:
+            self.marks[self.mark(fields[b'mark'])] = future
+
+    def commit(self, ref):
+        fields, line = self.fields(b'mark', b'original-oid', b'author', b'committer', b'encoding')
+        if b'committer' not in fields:
+            raise Exception("Missing committer in commit {0}".format(ref.decode("utf-8", "replace")))
+        message = self.data(line)
+
+        branch = self.branches.get(ref)
+        parents = []
+        line = self.line()
+        if line is not None and line.startswith(b'from '):
+            parent = self.commitish(line[5:])
+            parents.append(parent)
+            if branch and branch[0] == parent:
+                tree = branch[1]
+            else:
+                tree = ImportTree(self.commit_tree(parent))
+            line = self.line()
+        elif branch and branch[0] is not None:
+            parents.append(branch[0])
+            tree = branch[1]
+        else:
+            tree = ImportTree(None, dict())
+        while line is not None and line.startswith(b'merge '):
+            parents.append(self.commitish(line[6:]))
+            line = self.line()
+
+        while line is not None:
+            if line.startswith(b'M '):
+                mode, dataref, path = line[2:].split(b' ', 2)
+                path = unquote_path(path)
+                if dataref == b'inline':
+                    sha = self.store(b'blob', self.data(self.line()))
+                else:
+                    sha = self.dataref(dataref)
+                mode = int(mode, 8)
+                if mode in (0o644, 0o755):
+                    mode |= 0o100000
+                self.tree_set(tree, path, mode, sha)
+            elif line.startswith(b'D '):
+                self.tree_delete(tree, unquote_path(line[2:]))
+            elif line == b'deleteall':
+                tree = ImportTree(None, dict())
+            else:
+                self.unread(line)
+                break
+            line = self.line()
+
+        tree_sha = self.write_tree(tree)
+        lines = [b'tree ' + tree_sha.hex().encode()]
+        lines += [b'parent ' + p.hex().encode() for p in parents]
+        lines.append(b'author ' + fields.get(b'author', fields[b'committer']))
+        lines.append(b'committer ' + fields[b'committer'])
+        if b'encoding' in fields:
+            lines.append(b'encoding ' + fields[b'encoding'])
+        data = b'\n'.join(lines) + b'\n\n' + message
+        sha = self.resolve(self.store(b'commit', data))
+        self.commit_trees[sha] = tree_sha
+        self.branches[ref] = [sha, tree]
+        if b'mark' in fields:
+            self.marks[self.mark(fields[b'mark'])] = sha
+
+    def tag(self, name):
+        fields, line = self.fields(b'mark', b'from', b'original-oid', b'tagger')
+        if b'from' not in fields:
+            raise Exception("Missing from in tag {0}".format(name.decode("utf-8", "replace")))
+        message = self.data(line)
+        target = self.commitish(fields[b'from'])
+        fmt, _ = self.read(target)
+        lines = [b'object ' + target.hex().encode(),
+                 b'type ' + fmt,
+                 b'tag ' + name]
+        if b'tagger' in fields:
+            lines.append(b'tagger ' + fields[b'tagger'])
+        data = b'\n'.join(lines) + b'\n\n' + message
+        sha = self.resolve(self.store(b'tag', data))
+        self.branches[b'refs/tags/' + name] = [sha, None]
+        if b'mark' in fields:
+            self.marks[self.mark(fields[b'mark'])] = sha
+
+    def reset(self, ref):
+        line = self.line()
+        if line is not None and line.startswith(b'from '):
+            sha = self.commitish(line[5:])
+            self.branches[ref] = [sha, ImportTree(self.commit_tree(sha))]
+        else:
+            if line is not None:
+                self.unread(line)
+            self.branches[ref] = [None, ImportTree(None, dict())]
+
+    def tree_load(self, tree):
+        if tree.entries is None:
+            fmt, data = self.read(tree.sha)
+            entries = dict()
+            for leaf in Tree(None, data):
+                mode = int(leaf.mode, 8)
+                if mode == 0o40000:
+                    entries[leaf.path] = (mode, ImportTree(leaf.binsha))
+                else:
+                    entries[leaf.path] = (mode, leaf.binsha)
+            tree.entries = entries
+
+    def tree_set(self, tree, path, mode, sha):
+        parts = path.split(b'/')
+        for name in parts[:-1]:
+            self.tree_load(tree)
+            tree.sha = None
+            entry = tree.entries.get(name)
+            if entry is None or entry[0] != 0o40000:
+                entry = (0o40000, ImportTree(None, dict()))
+                tree.entries[name] = entry
+            tree = entry[1]
+        self.tree_load(tree)
+        tree.sha = None
+        if mode == 0o40000:
+            tree.entries[parts[-1]] = (mode, ImportTree(self.resolve(sha)))
+        else:
+            tree.entries[parts[-1]] = (mode, sha)
+
+    # Remove path, and the directories it leaves empty.
+    def tree_delete(self, tree, path):
+        parts = path.split(b'/')
+        stack = []
+        for name in parts[:-1]:
+            self.tree_load(tree)
+            entry = tree.entries.get(name)
+            if entry is None or entry[0] != 0o40000:
+                return
+            stack.append((tree, name))
+            tree = entry[1]
+        self.tree_load(tree)
+        if tree.entries.pop(parts[-1], None) is None:
+            return
+        tree.sha = None
+        for parent, name in reversed(stack):
+            parent.sha = None
+            if not tree.entries:
+                del parent.entries[name]
+            tree = parent
+
+    # Store the changed directories of tree, deepest first, and return
+    # the binary SHA of its root.
+    def write_tree(self, tree):
+        if tree.sha is not None:
+            return tree.sha
+        items = []
+        for name, (mode, value) in tree.entries.items():
+            if mode == 0o40000:
+                if value.entries is not None and not value.entries:
+                    continue
+                items.append((name + b'/', b'40000 ' + name + b'\x00' + self.write_tree(value)))
+            else:
+                if not isinstance(value, bytes):
+                    value = self.resolve(value)
+                    tree.entries[name] = (mode, value)
+                items.append((name, b'%o %s\x00' % (mode, name) + value))
+        items.sort()
+        tree.sha = self.resolve(self.store(b'tree', b''.join(item for _, item in items)))
+        return tree.sha
+# /PYG FAST-IMPORT
+
+# PYG FSCK
+# fsck reads every object, loose and packed, and checks that its data
+# hashes to its name and parses, then that everything referenced by a
+# tree, commit or tag, or by the index, exists with the right type.
+# Objects are checked in chunks by a pool of processes; packed objects
+# go in pack order, so that delta bases are found in the delta cache of
+# the worker.  Objects that nothing refers to, not even a ref or HEAD,
+# are reported as dangling.
+
+@command("fsck", help="Verify the connectivity and validity of the objects.")
+def args_fsck(argsp):
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of worker processes (default: one per CPU)")
+    argsp.add_argument("--no-dangling",
+                       action="store_false",
+                       dest="dangling",
+                       help="Don't report dangling objects")
+
+def cmd_fsck(args):
+    repo = get_repo()
+    result = fsck(repo, args.jobs)
+    for sha, message in result["corrupt"]:
+        print("corrupt {0}: {1}".format(sha, message))
+    for message in result["broken"]:
+        print(message)
+    for fmt, sha in result["missing"]:
+        print("missing {0} {1}".format(fmt.decode("ascii"), sha))
+    if args.dangling:
+        for fmt, sha in result["dangling"]:
+            print("dangling {0} {1}".format(fmt.decode("ascii"), sha))
+    print("Checked {0} objects ({1} loose, {2} packed, {3:.1f} MiB) in {4:.2f}s, {5:.0f} objects/s".format(
+        result["loose"] + result["packed"], result["loose"], result["packed"], result["bytes"] / 1024 ** 2,
+        result["seconds"], (result["loose"] + result["packed"]) / max(result["seconds"], 1e-9)), file=sys.stderr)
+    if result["corrupt"] or result["broken"] or result["missing"]:
+        sys.exit(1)
+
+# Objects per task given to a worker
+FSCK_CHUNK = 2048
+
+FSCK_MODES = (b'100644', b'100755', b'120000', b'40000', b'160000')
+
+# Check every object of repo with jobs processes.  Return a dict with the
+# number of loose and packed objects checked, the bytes hashed, the time
+# taken and the lists of problems found: corrupt objects as (sha,
+# message), broken refs and links as messages, and missing and dangling
+# objects as (type, sha).
+def fsck(repo, jobs=None):
+    import concurrent.futures
+    start = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    tasks = []
+    loose = sorted(sha for sha, _ in loose_objects(repo))
+    for i in range(0, len(loose), FSCK_CHUNK):
+        tasks.append((fsck_objects, None, loose[i:i+FSCK_CHUNK]))
+    packed = 0
+    for pack in repo_packs(repo):
+        tasks.append((fsck_pack, pack.path))
+        order = array.array("L", sorted(range(pack.index.count), key=pack.index.offset))
+        for i in range(0, len(order), FSCK_CHUNK):
+            tasks.append((fsck_objects, pack.path, order[i:i+FSCK_CHUNK]))
+        packed += len(order)
+
+    if jobs <= 1:
+        results = [fn(repo, *args) for fn, *args in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(fn, repo.worktree, *args) for fn, *args in tasks]
+            results = [f.result() for f in futures]
+
+    # binsha -> type, of the objects found and of those referenced
+    objects = dict()
+    links = dict()
+    corrupt = []
+    broken = []
+    size = 0
+    for result in results:
+        if type(result) == list:
+            broken.extend(result)
+            continue
+        found, referenced, bad, n = result
+        for binsha, fmt in found:
+            objects[binsha] = fmt
+        for binsha, fmt in referenced:
+            links.setdefault(binsha, fmt)
+        corrupt.extend(bad)
+        size += n
+    bad = {bytes.fromhex(sha) for sha, _ in corrupt}
+
+    # Refs and HEAD may point to an object of any type; index entries
+    # are blobs (or gitlinks, which are not in this repository).
+    roots = set()
+    refs = repo_refs(repo).all()
+    head = resolve_ref(repo, "HEAD")
+    if head:
+        refs.append(("HEAD", head))
+    for name, sha in refs:
+        binsha = bytes.fromhex(sha)
+        roots.add(binsha)
+        if binsha not in objects and binsha not in bad:
+            broken.append("broken ref {0}: {1} is missing".format(name, sha))
+    if os.path.exists(repo_path(repo, "index")):
+        index = read_index(repo)
+        for i, binsha in enumerate(index.shas):
+            if index.mode[i] != 0o160000:
+                links.setdefault(binsha, b'blob')
+
+    missing = []
+    for binsha, fmt in links.items():
+        found = objects.get(binsha)
+        if found is None:
+            if binsha not in bad:
+                missing.append((fmt, binsha.hex()))
+        elif found != fmt:
+            broken.append("wrong type {0}: {1} expected, found {2}".format(
+                binsha.hex(), fmt.decode("ascii"), found.decode("ascii")))
+    dangling = [(fmt, binsha.hex()) for binsha, fmt in objects.items()
+                if binsha not in links and binsha not in roots]
+    return {
+        "loose": len(loose),
+        "packed": packed,
+        "bytes": size,
+        "seconds": time.perf_counter() - start,
+        "corrupt": sorted(corrupt),
+        "broken": broken,
+        "missing": sorted(missing, key=lambda m: m[1]),
+        "dangling": sorted(dangling, key=lambda d: d[1]),
+    }
+
+# Worker processes open the repository once, like checkout's.
+fsck_worker_repo = None
+
+def fsck_repo(repo):
+    global fsck_worker_repo
+    if isinstance(repo, str):
+        if fsck_worker_repo is None or fsck_worker_repo.worktree != repo:
+            fsck_worker_repo = Repository(repo)
+        repo = fsck_worker_repo
+    return repo
+
+# Check a chunk of objects: loose SHAs if pack_path is None, otherwise
+# positions in the index of that pack.  Return (found, referenced, bad,
+# size): the (binsha, type) of the good objects and of the objects they
+# refer to, the (sha, message) of the bad ones, and the bytes hashed.
+def fsck_objects(repo, pack_path, items):
+    import hashlib
+    repo = fsck_repo(repo)
+    pack = None
+    if pack_path:
+        pack = next(p for p in repo_packs(repo) if p.path == pack_path)
+    found = []
+    referenced = []
+    bad = []
+    size = 0
+    for item in items:
+        sha = item if pack is None else pack.index.sha(item).hex()
+        try:
+            if pack is None:
+                fmt, n, chunks = read_object_stream(repo, sha)
+            else:
+                fmt, n, chunks = pack.read_stream(pack.index.offset(item), STREAM_CHUNK)
+            # Only blobs are not kept: they can be huge, and have no links.
+            h = hashlib.sha1(fmt + b' ' + str(n).encode() + b'\x00')
+            data = []
+            for chunk in chunks:
+                h.update(chunk)
+                if fmt != b'blob':
+                    data.append(chunk)
+            if h.hexdigest() != sha:
+                raise Exception("hash mismatch, its data hashes to {0}".format(h.hexdigest()))
+            referenced.extend(fsck_links(repo, fmt, b''.join(data)))
+        except Exception as e:
+            bad.append((sha, str(e) or "malformed object"))
+            continue
+        found.append((bytes.fromhex(sha), fmt))
+        size += n
+    return found, referenced, bad, size
+
+# Return the (binsha, type) of the objects referred to by the object of
+# type fmt with data, checking that it parses.
+def fsck_links(repo, fmt, data):
+    ret = []
+    if fmt == b'tree':
+        tree = Tree(repo, data)
+        prev = None
+        for i in range(len(tree)):
+            leaf = tree[i]
+            if leaf.mode not in FSCK_MODES:
+                raise Exception("bad mode {0} for {1}".format(leaf.mode.decode("ascii", "replace"),
+                                                               leaf.path.decode("utf-8", "replace")))
+            key = tree.key(i)
+            if prev is not None and key <= prev:
+                raise Exception("{0} entry {1}".format("duplicate" if key == prev else "misordered",
+                                                       leaf.path.decode("utf-8", "replace")))
+            prev = key
+            kind = mode_type(leaf.mode)
+            if kind != b'commit':
+                ret.append((leaf.binsha, kind))
+    elif fmt == b'commit':
+        commit = Commit(repo, data)
+        trees = commit.headers(b'tree')
+        if len(trees) != 1:
+            raise Exception("{0} tree headers".format(len(trees)))
+        ret.append((fsck_sha(trees[0]), b'tree'))
+        for parent in commit.headers(b'parent'):
+            ret.append((fsck_sha(parent), b'commit'))
+        for key in (b'author', b'committer'):
+            if commit.header(key) is None:
+                raise Exception("no {0}".format(key.decode("ascii")))
+    elif fmt == b'tag':
+        tag = Tag(repo, data)
+        obj = tag.header(b'object')
+        kind = tag.header(b'type')
+        if obj is None or kind not in PACK_KINDS or tag.header(b'tag') is None:
+            raise Exception("bad tag headers")
+        ret.append((fsck_sha(obj), kind))
+    elif fmt != b'blob':
+        raise Exception("unknown type {0}".format(fmt.decode("ascii", "replace")))
+    return ret
+
+def fsck_sha(value):
+    try:
+        binsha = bytes.fromhex(value.decode("ascii"))
+    except ValueError:
+        binsha = b''
+    if len(binsha) != 20:
+        raise Exception("bad SHA {0}".format(value.decode("ascii", "replace")))
+    return binsha
+
+# Verify the checksums of a pack and of its index.  Return a list of
+# error messages.
+def fsck_pack(repo, pack_path):
+    import hashlib
+    ret = []
+    idx_path = pack_path[:-5] + ".idx"
+    checksums = []
+    for path in (pack_path, idx_path):
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            if hashlib.sha1(view[:-20]).digest() != m[-20:]:
+                ret.append("bad checksum in {0}".format(path))
+            view.release()
+            checksums.append(m[-40:-20] if path == idx_path else m[-20:])
+    if checksums[0] != checksums[1]:
+        ret.append("{0} does not match its pack".format(idx_path))
+    return ret
+# /PYG FSCK
+
+# PYG ASYNC
+# AsyncRepository lets an asyncio service read a repository without
+# blocking its event loop: reads and inflation run in a thread pool of
+# bounded size (zlib and file I/O release the GIL), and concurrent
+# requests for the same object or name share one load.  It must be used
+# from a single event loop.
+#
+#     async with AsyncRepository(path) as repo:
+#         blobs = await asyncio.gather(*(repo.read_object(sha) for sha in shas))
+
+class AsyncRepository(object):
+    repo = None
+
+    def __init__(self, repo, jobs=None, executor=None):
+        import concurrent.futures
+        if not isinstance(repo, Repository):
+            repo = Repository(repo)
+        self.repo = repo
+        self.owns_executor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            jobs or min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="pyg-async")
+        # key -> asyncio future of the load in progress
+        self.pending = dict()
+        # RefStore reloads its files in place: refs are read one at a time.
+        self.refs_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def run(self, fn, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # Run fn(*args) in the executor, unless a call with the same key is
+    # already running: then wait for its result.  A waiter being
+    # cancelled doesn't cancel the load for the others.
+    async def coalesce(self, key, fn, *args):
+        import asyncio
+        future = self.pending.get(key)
+        if future is None:
+            future = self.pending[key] = asyncio.ensure_future(self.run(fn, *args))
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    # See read_object().  Objects already in the object cache are
+    # returned without going through the executor; on a miss, the lookup
+    # is counted (once) by read_object() in the executor.
+    async def read_object(self, sha):
+        obj = self.repo.object_cache.get(sha, count_miss=False)
+        if obj is not None:
+            perf.add("object_cache.hits")
+            return obj
+        return await self.coalesce(("object", sha), read_object, self.repo, sha)
+
+    async def read_objects(self, shas):
+        import asyncio
+        return await asyncio.gather(*(self.read_object(sha) for sha in shas))
+
+    # Return (size, chunks) for blob sha, where chunks is an async
+    # iterator over its data, inflated in the executor chunk by chunk
+    # (see read_object_stream()).
+    async def read_blob_stream(self, sha, chunk_size=STREAM_CHUNK):
+        fmt, size, chunks = await self.run(read_object_stream, self.repo, sha, chunk_size)
+        if fmt != b'blob':
+            if hasattr(chunks, "close"):
+                chunks.close()
+            raise Exception("Object {0} is a {1}, not a blob".format(sha, fmt.decode("ascii")))
+        return size, self.stream(chunks)
+
+    async def stream(self, chunks):
+        try:
+            while True:
+                data = await self.run(next, chunks, None)
+                if data is None:
+                    return
+                yield data
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    # See get_object().
+    async def resolve(self, name, fmt=None, follow=True):
+        return await self.coalesce(("resolve", name, fmt, follow), self.refs_call,
+                                   get_object, name, fmt, follow)
+
+    # See list_refs().
+    async def list_refs(self):
+        return await self.coalesce(("refs",), self.refs_call, list_refs)
+
+    def refs_call(self, fn, *args):
+        with self.refs_lock:
+            return fn(self.repo, *args)
+# /PYG ASYNC
+
+# PYG PERF
+# Counters and timers, off unless PYG_TRACE_PERF is set or --perf is
+# given.  Counters (bytes read, inflated, deflated and written, cache
+# hits and misses) are bumped by perf.add() where the work is done;
+# calls and wall time of the functions in PERF_TIMED are measured by
+# wrappers that enable() puts in their place, so that nothing but a
+# counter call is paid while disabled.  On exit, main() hands the report
+# to perf.flush(), which prints it and passes it to every hook.
+# PYG_TRACE_PERF is "1" (or "summary") for a summary on stderr, "json"
+# for JSON lines on stderr, or an absolute path to append JSON lines to.
+
+PERF_TIMED = [
+    "read_object", "read_object_raw", "read_object_header", "read_object_stream",
+    "write_object", "hash_object_stream", "resolve_ref", "resolve_object",
+    "parse_map_with_msg", "parse_tree", "tree_offsets", "apply_delta", "create_delta",
+    "read_index", "write_index", "Pack.read", "Commit.headers", "RefStore.load_packed",
+    # Phases of checkout and status
+    "checkout_plan", "checkout_files", "checkout_write", "tree_flatten", "scan_worktree",
+]
+
+PERF_OFF = ("", "0", "false", "no", "off")
+
+class Perf(object):
+    enabled = False
+    # None (hooks only), "summary", "json" or the path of a file
+    output = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        # name -> [calls, seconds]
+        self.timers = dict()
+        self.hooks = []
+        # (owner, name, original) of the functions replaced by enable()
+        self.wrapped = []
+        self.local = threading.local()
+        self.start = time.perf_counter()
+
+    def add(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def enable(self, output=None):
+        self.output = output
+        if self.enabled:
+            return
+        self.enabled = True
+        self.reset()
+        module = sys.modules[__name__]
+        for name in PERF_TIMED:
+            owner = module
+            attr = name
+            if "." in name:
+                cls, attr = name.split(".")
+                owner = getattr(module, cls)
+            original = getattr(owner, attr)
+            self.wrapped.append((owner, attr, original))
+            setattr(owner, attr, self.wrap(name, original))
+
+    def disable(self):
+        for owner, attr, original in reversed(self.wrapped):
+            setattr(owner, attr, original)
+        self.wrapped = []
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = collections.Counter()
+            self.timers = dict()
+            self.start = time.perf_counter()
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            # Only the outermost call is timed: a function calling itself
+            # (read_object_raw for REF_DELTA bases) would count twice.
+            active = self.local.__dict__.setdefault("active", set())
+            if name in active:
+                self.record(name, 0)
+                return fn(*args, **kwargs)
+            active.add(name)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                active.discard(name)
+                self.record(name, time.perf_counter() - start)
+        timed.__name__ = fn.__name__
+        timed.__qualname__ = fn.__qualname__
+        timed.__doc__ = fn.__doc__
+        return timed
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+
+    # Time a phase of a command: "with perf.timer("checkout.write"):".
+    def timer(self, name):
+        return PerfTimer(self, name)
+
+    def report(self, command=None):
+        with self.lock:
+            return {
+                "command": command,
+                "seconds": time.perf_counter() - self.start,
+                "counters": dict(self.counters),
+                "timers": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in self.timers.items()},
+            }
+
+    # Emit the report of everything measured since the last flush, pass
+    # it to the hooks and start over.
+    def flush(self, command=None):
+        report = self.report(command)
+        self.reset()
+        if self.output in ("summary", "json"):
+            perf_write(report, self.output, sys.stderr)
+        elif self.output:
+            with open(self.output, "a") as f:
+                perf_write(report, "json", f)
+        for hook in list(self.hooks):
+            hook(report)
+        return report
+
+class PerfTimer(object):
+    def __init__(self, perf, name):
+        self.perf = perf
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.perf.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.perf.record(self.name, time.perf_counter() - self.start)
+        return False
+
+perf = Perf()
+
+# Register fn to be called with the report (a dict, see Perf.report())
+# every time perf is flushed.  Can be used as a decorator.
+def perf_hook(fn):
+    perf.hooks.append(fn)
+    return fn
+
+def perf_unhook(fn):
+    perf.hooks.remove(fn)
+
+# Enable perf as requested by --perf and PYG_TRACE_PERF.
+def perf_setup(flag):
+    trace = os.environ.get("PYG_TRACE_PERF", "").strip()
+    if trace.lower() in PERF_OFF:
+        if not flag:
+            return
+        trace = "summary"
+    elif trace.lower() in ("1", "true", "yes", "on", "summary"):
+        trace = "summary"
+    elif trace.lower() == "json":
+        trace = "json"
+    elif not os.path.isabs(trace):
+        raise Exception("PYG_TRACE_PERF must be 1, json or an absolute path, not {0}".format(trace))
+    perf.enable(trace)
+
+def perf_write(report, output, f):
+    import json
+    command = report["command"]
+    if output == "json":
+        lines = [{"event": "command", "command": command, "seconds": report["seconds"]}]
+        for name, timer in sorted(report["timers"].items()):
+            lines.append(dict(event="timer", command=command, name=name, **timer))
+        for name, value in sorted(report["counters"].items()):
+            lines.append({"event": "counter", "command": command, "name": name, "value": value})
+        for line in lines:
+            f.write(json.dumps(line) + "\n")
+        return
+    f.write("perf: {0} in {1:.3f}s\n".format(command or "-", report["seconds"]))
+    for name, timer in sorted(report["timers"].items(), key=lambda t: -t[1]["seconds"]):
+        f.write("  {0:<24} {1:>10} calls {2:>10.4f}s\n".format(name, timer["calls"], timer["seconds"]))
+    for name, value in sorted(report["counters"].items()):
+        f.write("  {0:<24} {1:>10}\n".format(name, value))
+# /PYG PERF